@@ -1,4 +1,117 @@
-from . import generate, cosmos
+"""Command line interface.
 
-ach = generate.get_achievements()
-# cosmos.save(ach)
+    python -m cfa download [--stages rating-changes submissions] [--incremental]
+    python -m cfa download --retry-failed
+    python -m cfa download --shards 4
+    python -m cfa download --pipeline --bulk
+    python -m cfa generate [--only rank] [--workers 4]
+    python -m cfa save [--sink jsonl --path docs.jsonl]
+    python -m cfa rebuild-aggregates
+
+Modules are imported by the subcommand that needs them, so that e.g. generate doesn't pay for
+requests or the Azure SDK.
+"""
+import argparse
+
+# download.STAGES, repeated so that parsing arguments doesn't import download
+DOWNLOAD_STAGES = ['users', 'contests', 'standings', 'hacks', 'rating-changes', 'submissions']
+SINKS = ['cosmos', 'jsonl', 'sqlite', 'fake']
+
+
+def _download(args):
+    from . import download
+
+    download.main(args.db, incremental=args.incremental, cache_dir=args.cache_dir,
+                  offline=args.offline, bulk=args.bulk, stages=args.stages,
+                  retry_failed=args.retry_failed, shards=args.shards, pipelined=args.pipeline)
+
+
+def _rebuild_aggregates(args):
+    from . import aggregates
+
+    aggregates.rebuild(args.db)
+
+
+def _generate(args):
+    from . import generate
+
+    if args.incremental:
+        achs, _ = generate.get_achievements_incremental(args.db, only=args.only)
+        return achs
+    return generate.get_achievements(args.db, workers=args.workers, use_cache=not args.no_cache,
+                                     only=args.only)
+
+
+def _save(args):
+    from . import cosmos, sinks
+
+    if args.sink in ('jsonl', 'sqlite') and args.path is None:
+        raise SystemExit(f'--path is needed for the {args.sink} sink')
+    ru_per_sec = args.ru_per_sec or cosmos.COSMOS_DB_RU_PER_SEC
+    achs = _generate(args)
+    if args.sink == 'cosmos':
+        sink = sinks.CosmosSink()
+    elif args.sink == 'jsonl':
+        sink = sinks.JsonlSink(args.path)
+    elif args.sink == 'sqlite':
+        sink = sinks.SqliteSink(args.path)
+    else:
+        sink = sinks.FakeCosmosSink(ru_per_sec)
+    cosmos.save(achs, sink, ru_per_sec=ru_per_sec)
+
+
+def _add_generate_arguments(p: argparse.ArgumentParser):
+    p.add_argument('--db', default='cf.db')
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--incremental', action='store_true',
+                   help='recalculate only for data changed since the last incremental run')
+    p.add_argument('--no-cache', action='store_true', help="don't use the grant cache")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m cfa', description='Codeforces achievements')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('download', help='download Codeforces data into the database')
+    p.add_argument('--db', default='cf.db')
+    p.add_argument('--stages', nargs='+', choices=DOWNLOAD_STAGES, metavar='STAGE',
+                   help=f'stages to run, of {", ".join(DOWNLOAD_STAGES)}; all by default')
+    p.add_argument('--incremental', action='store_true',
+                   help='also refetch contests that were running when last fetched')
+    p.add_argument('--cache-dir', help='keep raw API responses in this directory')
+    p.add_argument('--offline', action='store_true', help='read responses from --cache-dir only')
+    p.add_argument('--bulk', action='store_true', help='fast unsafe writes for a first download')
+    p.add_argument('--retry-failed', action='store_true',
+                   help='only retry the contests whose downloads failed before')
+    p.add_argument('--shards', type=int, default=1,
+                   help='download contests in this many processes, each into its own database')
+    p.add_argument('--pipeline', action='store_true',
+                   help='overlap fetching, parsing and writing submissions')
+    p.set_defaults(func=_download)
+
+    p = subparsers.add_parser('rebuild-aggregates',
+                              help='recalculate the per-user aggregate tables from scratch')
+    p.add_argument('--db', default='cf.db')
+    p.set_defaults(func=_rebuild_aggregates)
+
+    p = subparsers.add_parser('generate', help='calculate the grants of the achievements')
+    _add_generate_arguments(p)
+    p.add_argument('--only', nargs='+', metavar='MODULE',
+                   help='only load the achievements of these modules of cfa.achievements')
+    p.set_defaults(func=_generate)
+
+    p = subparsers.add_parser('save', help='calculate the grants and upload the documents')
+    _add_generate_arguments(p)
+    p.add_argument('--sink', choices=SINKS, default='cosmos')
+    p.add_argument('--path', help='output file of the jsonl and sqlite sinks')
+    p.add_argument('--ru-per-sec', type=float,
+                   help='provisioned throughput to pace uploads by, 400 by default')
+    # Documents always cover every achievement
+    p.set_defaults(func=_save, only=None)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
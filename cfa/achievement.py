@@ -1,5 +1,5 @@
 import string
-from typing import Callable, List, NamedTuple
+from typing import Callable, Dict, Hashable, Iterable, List, NamedTuple, Optional
 
 DEFAULT_ICON_NAME = 'default.svg'
 
@@ -11,40 +11,107 @@ class Achievement:
     def __init__(
             self, *, title: str, brief: str, description: str = None,
             icon_name: str = DEFAULT_ICON_NAME,
-            calculate_grants: Callable[[], List[Grant]]):
+            calculate_grants: Callable[..., List[Grant]], incremental: bool = False,
+            snapshot: bool = False):
         self.title = title
         self.brief = brief
         self.description = description or brief
         self.icon_name = icon_name
         self.calculate_grants = calculate_grants
+        # Whether calculate_grants takes `user_ids`, a query of user ids to limit the grants to
+        self.incremental = incremental
+        # Whether calculate_grants takes `snapshot`, the current snapshot.Snapshot
+        self.snapshot = snapshot
+        self.family: Optional[AchievementFamily] = None
+        self.family_key: Hashable = None
 
     def __repr__(self):
         return f'Achievement<{self.title}>'
 
+class AchievementFamily:
+    """Achievements whose grants are all calculated at once, e.g. by one GROUP BY query."""
+
+    def __init__(self, calculate_grants: Callable[..., Dict[Hashable, List[Grant]]]):
+        self.calculate_grants = calculate_grants
+        self.members: List[Achievement] = []
+
+    def __repr__(self):
+        return f'AchievementFamily<{self.members[0].title}, ...>'
+
+class FamilyMember(NamedTuple):
+    key: Hashable
+    title: str
+    brief: str
+    description: str = None
+    icon_name: str = DEFAULT_ICON_NAME
+
 class AchievementWithStats(NamedTuple):
     achievement: Achievement
     grants: List[Grant]
     users_awarded: int
     users_awarded_fraction: float
+    # Seconds spent calculating the grants, None if they came from the GrantCache. A family is
+    # calculated at once, so its first member has the time of the whole family and the rest 0.
+    elapsed: Optional[float] = None
 
 
 _achievements: List[Achievement] = []
 
 def register(
         *, title: str, brief: str, description: str = None,
-        icon_name: str = DEFAULT_ICON_NAME, ignore: bool = False):
-    """Decorator that creates and registers an achievement."""
+        icon_name: str = DEFAULT_ICON_NAME, ignore: bool = False, incremental: bool = False,
+        snapshot: bool = False):
+    """Decorator that creates and registers an achievement.
+
+    With `incremental`, the function must accept a `user_ids` keyword argument, a query of user
+    ids usable with .in_(), and then return only the grants of those users. Incremental generation
+    uses it to recalculate grants for changed users only.
 
-    def deco(func: Callable[[], List[Grant]]):
+    With `snapshot`, the function is passed the columnar snapshot of the database as the
+    `snapshot` keyword argument, see the snapshot module.
+    """
+
+    def deco(func: Callable[..., List[Grant]]):
         if ignore:
             return
         achievement = Achievement(title=title, brief=brief, description=description,
-                                  calculate_grants=func)
+                                  calculate_grants=func, incremental=incremental,
+                                  snapshot=snapshot)
         _achievements.append(achievement)
         return func
 
     return deco
 
 
+def register_family(
+        members: Iterable[FamilyMember], *, ignore: bool = False, incremental: bool = False,
+        snapshot: bool = False):
+    """Decorator that creates and registers a family of achievements calculated together.
+
+    The decorated function returns the grants of all members as a dict from member key to grants;
+    members missing from the dict get no grants. Each member is still a regular achievement, and
+    get_achievements calls the function once for the whole family. `incremental` and `snapshot`
+    are as for register.
+    """
+
+    def deco(func: Callable[..., Dict[Hashable, List[Grant]]]):
+        if ignore:
+            return
+        family = AchievementFamily(func)
+        for member in members:
+            achievement = Achievement(
+                title=member.title, brief=member.brief, description=member.description,
+                icon_name=member.icon_name,
+                calculate_grants=lambda key=member.key, **kwargs: func(**kwargs).get(key, []),
+                incremental=incremental, snapshot=snapshot)
+            achievement.family = family
+            achievement.family_key = member.key
+            family.members.append(achievement)
+            _achievements.append(achievement)
+        return func
+
+    return deco
+
+
 def registered_achievements():
     return _achievements
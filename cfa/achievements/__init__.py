@@ -1 +1,15 @@
-from . import rank
+import importlib
+from typing import Iterable
+
+# Modules defining achievements, in registration order. Importing one registers its achievements.
+MODULES = [
+    'rank',
+]
+
+
+def load(modules: Iterable[str] = None):
+    """Imports the given achievement modules, or all of them."""
+    for name in MODULES if modules is None else modules:
+        if name not in MODULES:
+            raise ValueError(f'unknown achievement module {name!r}, expected one of {MODULES}')
+        importlib.import_module(f'{__name__}.{name}')
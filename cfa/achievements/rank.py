@@ -1,18 +1,9 @@
+from collections import defaultdict
 from dataclasses import dataclass
 
-from ..achievement import Grant, register
+from ..achievement import FamilyMember, Grant, register_family
 from ..models import User, RatingChange
 
-def register_rank(rank):
-    @register(
-        title=rank,
-        brief="I'm a " + rank,
-        description='Have rank ' + rank)
-    def func():
-        users = User.select().where(User.rank == rank.lower())
-        grants = [Grant(user.handle, rank) for user in users]
-        return grants
-
 all_ranks = [
     'Newbie',
     'Pupil',
@@ -26,5 +17,22 @@ all_ranks = [
     'Legendary Grandmaster',
 ]
 
-for rank in all_ranks:
-    register_rank(rank)
+@register_family(
+    [FamilyMember(
+        rank.lower(),
+        title=rank,
+        brief="I'm a " + rank,
+        description='Have rank ' + rank)
+     for rank in all_ranks],
+    incremental=True)
+def rank_grants(user_ids=None):
+    titles = {rank.lower(): rank for rank in all_ranks}
+    users = (User
+             .select(User.handle, User.rank)
+             .where(User.rank.in_(list(titles))))
+    if user_ids is not None:
+        users = users.where(User.id.in_(user_ids))
+    grants = defaultdict(list)
+    for handle, rank in users.tuples():
+        grants[rank].append(Grant(handle, titles[rank]))
+    return grants
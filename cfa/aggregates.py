@@ -0,0 +1,171 @@
+"""Per-user aggregates, so that achievements don't have to go over the raw rows every time.
+
+download calls update_contest after writing the data of a contest from an endpoint, which
+recalculates the aggregates derived from that endpoint for the users involved. rebuild
+recalculates everything, e.g. after a bulk load, which skips the per-contest updates, or after
+changing how an aggregate is defined:
+
+    python -m cfa rebuild-aggregates
+
+Users who never took part in anything may be missing from UserStats until a rebuild.
+"""
+import time
+from typing import Optional
+
+from peewee import JOIN, chunked, fn
+
+from . import models
+from .models import User, Problem, ProblemTag, ContestProblem, Submission, Hack, RanklistRow
+from .models import RatingChange, ParticipantType, SolvedProblem, UserStats, UserSolvedByRating
+from .models import UserSolvedByTag
+
+AGGREGATE_MODELS = [SolvedProblem, UserStats, UserSolvedByRating, UserSolvedByTag]
+# Users per batch when refreshing solved counts, kept under SQLite's bound variable limit
+USER_BATCH_SIZE = 10000
+
+
+def _upsert_stats(query, fields):
+    """Writes UserStats fields from a query selecting the user id followed by those fields,
+    leaving the other fields of existing rows alone."""
+    (UserStats
+     .insert_from(query, [UserStats.user] + fields)
+     .on_conflict(conflict_target=[UserStats.user], preserve=fields)
+     .execute())
+
+
+# The refresh functions take `user_ids` or `problem_ids` as a query or list usable with .in_(),
+# or None for all of them.
+
+def refresh_contests(user_ids=None):
+    query = (User
+             .select(User.id, fn.COUNT(RanklistRow.id), fn.MIN(RanklistRow.rank))
+             .join(RanklistRow, JOIN.LEFT_OUTER, on=(
+                 (RanklistRow.user == User.id) &
+                 (RanklistRow.participant_type == ParticipantType.CONTESTANT.value)))
+             .group_by(User.id))
+    if user_ids is not None:
+        query = query.where(User.id.in_(user_ids))
+    _upsert_stats(query, [UserStats.contests, UserStats.best_rank])
+
+
+def refresh_rating_deltas(user_ids=None):
+    query = (User
+             .select(User.id, fn.MAX(RatingChange.new_rating - RatingChange.old_rating))
+             .join(RatingChange, JOIN.LEFT_OUTER, on=(RatingChange.user == User.id))
+             .group_by(User.id))
+    if user_ids is not None:
+        query = query.where(User.id.in_(user_ids))
+    _upsert_stats(query, [UserStats.max_rating_delta])
+
+
+def refresh_hacks(user_ids=None):
+    query = (User
+             .select(User.id, fn.COUNT(Hack.id))
+             .join(Hack, JOIN.LEFT_OUTER, on=(
+                 (Hack.hacker == User.id) &
+                 (Hack.verdict == Hack.Verdict.HACK_SUCCESSFUL.value)))
+             .group_by(User.id))
+    if user_ids is not None:
+        query = query.where(User.id.in_(user_ids))
+    _upsert_stats(query, [UserStats.successful_hacks])
+
+
+def refresh_solved(problem_ids=None):
+    """Recalculates who solved the given problems, then the solved counts of those users and of
+    those who no longer count as having solved them, e.g. after failing system tests."""
+    accepted = (Submission
+                .select(Submission.author, ContestProblem.problem)
+                .join(ContestProblem, on=(Submission.problem == ContestProblem.id))
+                .where(Submission.verdict == Submission.Verdict.OK.value)
+                .distinct())
+    solvers = SolvedProblem.select(SolvedProblem.user)
+    delete = SolvedProblem.delete()
+    if problem_ids is not None:
+        accepted = accepted.where(ContestProblem.problem.in_(problem_ids))
+        solvers = solvers.where(SolvedProblem.problem.in_(problem_ids))
+        delete = delete.where(SolvedProblem.problem.in_(problem_ids))
+        users = {user for user, in solvers.tuples()}
+
+    delete.execute()
+    SolvedProblem.insert_from(accepted, [SolvedProblem.user, SolvedProblem.problem]).execute()
+
+    if problem_ids is None:
+        refresh_solved_counts()
+        return
+    users.update(user for user, in solvers.tuples())
+    for piece in chunked(sorted(users), USER_BATCH_SIZE):
+        refresh_solved_counts(piece)
+
+
+def refresh_solved_counts(user_ids=None):
+    """Recalculates the solved counts from SolvedProblem."""
+    solved = (User
+              .select(User.id, fn.COUNT(SolvedProblem.id))
+              .join(SolvedProblem, JOIN.LEFT_OUTER, on=(SolvedProblem.user == User.id))
+              .group_by(User.id))
+    by_rating = (SolvedProblem
+                 .select(SolvedProblem.user, Problem.rating, fn.COUNT(SolvedProblem.id))
+                 .join(Problem, on=(SolvedProblem.problem == Problem.id))
+                 .where(Problem.rating.is_null(False))
+                 .group_by(SolvedProblem.user, Problem.rating))
+    by_tag = (SolvedProblem
+              .select(SolvedProblem.user, ProblemTag.tag, fn.COUNT(SolvedProblem.id))
+              .join(ProblemTag, on=(SolvedProblem.problem == ProblemTag.problem))
+              .group_by(SolvedProblem.user, ProblemTag.tag))
+    delete_by_rating = UserSolvedByRating.delete()
+    delete_by_tag = UserSolvedByTag.delete()
+    if user_ids is not None:
+        solved = solved.where(User.id.in_(user_ids))
+        by_rating = by_rating.where(SolvedProblem.user.in_(user_ids))
+        by_tag = by_tag.where(SolvedProblem.user.in_(user_ids))
+        delete_by_rating = delete_by_rating.where(UserSolvedByRating.user.in_(user_ids))
+        delete_by_tag = delete_by_tag.where(UserSolvedByTag.user.in_(user_ids))
+
+    _upsert_stats(solved, [UserStats.solved])
+    delete_by_rating.execute()
+    (UserSolvedByRating
+     .insert_from(by_rating, [UserSolvedByRating.user, UserSolvedByRating.rating,
+                              UserSolvedByRating.solved])
+     .execute())
+    delete_by_tag.execute()
+    (UserSolvedByTag
+     .insert_from(by_tag, [UserSolvedByTag.user, UserSolvedByTag.tag, UserSolvedByTag.solved])
+     .execute())
+
+
+def update_contest(contest_id: int, endpoint: str):
+    """Brings the aggregates derived from an endpoint up to date for the users of a contest whose
+    data from that endpoint was just written."""
+    if endpoint == 'contest.standings':
+        refresh_contests(RanklistRow.select(RanklistRow.user)
+                         .where(RanklistRow.contest == contest_id))
+        models.touch(UserStats)
+    elif endpoint == 'contest.ratingChanges':
+        refresh_rating_deltas(RatingChange.select(RatingChange.user)
+                              .where(RatingChange.contest == contest_id))
+        models.touch(UserStats)
+    elif endpoint == 'contest.hacks':
+        refresh_hacks(Hack.select(Hack.hacker).where(Hack.contest == contest_id))
+        models.touch(UserStats)
+    elif endpoint == 'contest.status':
+        refresh_solved(ContestProblem.select(ContestProblem.problem)
+                       .where(ContestProblem.contest == contest_id))
+        models.touch(*AGGREGATE_MODELS)
+
+
+def rebuild(db_path: Optional[str] = None):
+    """Recalculates all aggregates from scratch, connecting to `db_path` if not connected."""
+    if models.db.is_closed():
+        models.init(db_path)
+        models.connect()
+        models.create_tables()
+    start = time.monotonic()
+    with models.db.atomic():
+        for model in AGGREGATE_MODELS:
+            model.delete().execute()
+        refresh_solved()
+        refresh_contests()
+        refresh_rating_deltas()
+        refresh_hacks()
+        models.touch(*AGGREGATE_MODELS)
+    print('rebuilt aggregates', f'{time.monotonic() - start:.2f}s')
@@ -0,0 +1,278 @@
+import io
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable, Optional
+
+import requests
+
+from .cache import ResponseCache
+from .ratelimit import RateLimiter
+
+API_BASE = 'https://codeforces.com/api/'
+
+# Calls are started at most once per COOLDOWN seconds, however many are in flight.
+COOLDOWN = 1
+MAX_IN_FLIGHT = 4
+REPORT_EVERY = 60
+STREAM_CHUNK_SIZE = 1 << 16
+# (connect, read) timeouts in seconds; the read timeout is per socket read, not for the whole body
+TIMEOUT = (10, 60)
+# Transient failures are retried up to MAX_ATTEMPTS calls in all, waiting a random time of up to
+# BACKOFF_BASE * 2**retry seconds, capped at BACKOFF_MAX, before each retry.
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2
+BACKOFF_MAX = 60
+CALL_LIMIT_EXCEEDED = 'Call limit exceeded'
+CONTEST_NOT_STARTED = 'has not started'
+
+
+class ApiError(Exception):
+    """A response without a result, e.g. {'status': 'FAILED', 'comment': ...}.
+
+    Transient errors, like server errors or going over the call limit, are worth retrying; others,
+    like asking for a contest that doesn't exist, are not.
+    """
+
+    def __init__(self, response: dict, status_code: int = 200):
+        super().__init__(response)
+        self.response = response
+        self.status_code = status_code
+        self.call_limit = CALL_LIMIT_EXCEEDED in str(response.get('comment', ''))
+        self.not_started = CONTEST_NOT_STARTED in str(response.get('comment', ''))
+        self.transient = self.call_limit or status_code == 429 or status_code >= 500
+
+
+class Stats:
+    """Per-endpoint call counts, errors and latency."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.latency = defaultdict(float)
+
+    def record(self, path: str, elapsed: float, ok: bool):
+        endpoint = path.split('?')[0]
+        with self.lock:
+            self.calls[endpoint] += 1
+            self.latency[endpoint] += elapsed
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def record_retry(self, path: str):
+        with self.lock:
+            self.retries[path.split('?')[0]] += 1
+
+    def report(self) -> str:
+        with self.lock:
+            return '\n'.join(
+                f'  {endpoint}: {calls} calls, {self.errors[endpoint]} errors, '
+                f'{self.retries[endpoint]} retries, {self.latency[endpoint] / calls:.2f}s avg'
+                for endpoint, calls in sorted(self.calls.items()))
+
+
+limiter = RateLimiter(1 / COOLDOWN)
+stats = Stats()
+
+# When set, successful responses are written to the cache. With `offline` they are read from it
+# instead and nothing goes over the network, e.g. to rebuild the db after a schema change.
+cache: Optional[ResponseCache] = None
+offline = False
+
+# One keep-alive session per fetch_all worker thread, since sessions aren't documented as thread
+# safe. Each keeps its connection to the API open between calls.
+_local = threading.local()
+
+
+def session() -> requests.Session:
+    s = getattr(_local, 'session', None)
+    if s is None:
+        s = _local.session = requests.Session()
+        # requests decodes the body, also when streamed with iter_content
+        s.headers['Accept-Encoding'] = 'gzip'
+    return s
+
+
+def _error(r: requests.Response) -> ApiError:
+    """The ApiError of a response that isn't 200 OK."""
+    try:
+        j = r.json()
+    except ValueError:
+        j = None
+    if not isinstance(j, dict):
+        j = {'status': 'FAILED', 'comment': f'HTTP {r.status_code} {r.reason}'}
+    return ApiError(j, r.status_code)
+
+
+def _with_retries(path: str, call: Callable):
+    """Runs `call` under the rate limiter, retrying transient failures with exponential backoff
+    and full jitter. Going over the call limit also pauses the limiter, holding back the other
+    workers too."""
+    for attempt in range(MAX_ATTEMPTS):
+        limiter.acquire()
+        start = time.monotonic()
+        ok = False
+        try:
+            result = call()
+            ok = True
+            return result
+        except ApiError as e:
+            if not e.transient or attempt == MAX_ATTEMPTS - 1:
+                raise
+            error = e
+        except requests.RequestException as e:
+            # Connection errors, timeouts and bodies cut off midway
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            error = e
+        finally:
+            stats.record(path, time.monotonic() - start, ok)
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        if isinstance(error, ApiError) and error.call_limit:
+            limiter.pause(delay)
+        stats.record_retry(path)
+        print(f'retrying {path} in {delay:.1f}s: {error}')
+        time.sleep(delay)
+
+
+def _open_cached(path):
+    fp = cache.open(path) if cache is not None else None
+    if fp is None:
+        raise Exception('not cached: ' + path)
+    return fp
+
+
+def api_get(path):
+    if offline:
+        with _open_cached(path) as fp:
+            j = json.load(fp)
+        if 'result' not in j:
+            raise ApiError(j)
+        return j['result']
+
+    def call():
+        r = session().get(API_BASE + path, timeout=TIMEOUT)
+        if r.status_code != 200:
+            raise _error(r)
+        j = r.json()
+        if 'result' not in j:
+            raise ApiError(j)
+        if cache is not None:
+            cache.put(path, r.content)
+        return j['result']
+
+    return _with_retries(path, call)
+
+
+def api_get_stream(path):
+    """Like api_get, but spools the raw body to a file instead of decoding it.
+
+    The file is returned open at the start, to be parsed with iter_result.
+    """
+    if offline:
+        return _open_cached(path)
+
+    def call():
+        with session().get(API_BASE + path, timeout=TIMEOUT, stream=True) as r:
+            if r.status_code != 200:
+                raise _error(r)
+            chunks = r.iter_content(STREAM_CHUNK_SIZE)
+            if cache is not None:
+                return cache.put_stream(path, chunks)
+            fp = tempfile.TemporaryFile()
+            try:
+                for chunk in chunks:
+                    fp.write(chunk)
+                fp.seek(0)
+            except Exception:
+                fp.close()
+                raise
+            return fp
+
+    return _with_retries(path, call)
+
+
+_RESULT_START = re.compile(r'"result"\s*:\s*\[')
+_decoder = json.JSONDecoder()
+
+def iter_result(fp, chunk_size: int = STREAM_CHUNK_SIZE):
+    """Yields the items of the result array of a response one at a time.
+
+    Only about one chunk of the body is held in memory at once. Raises like api_get if the
+    response has no result.
+    """
+    text = io.TextIOWrapper(fp, encoding='utf-8')
+    buf = ''
+    while (m := _RESULT_START.search(buf)) is None:
+        chunk = text.read(chunk_size)
+        if not chunk:
+            raise ApiError(json.loads(buf))
+        buf += chunk
+
+    pos = m.end()
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            if pos == len(buf):
+                raise ValueError
+            item, pos = _decoder.raw_decode(buf, pos)
+        except ValueError:
+            # Item is cut off at the end of the buffer
+            chunk = text.read(chunk_size)
+            if not chunk:
+                raise ValueError('truncated response')
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+
+
+def fetch_all(items: Iterable, path_of: Callable, workers: int = MAX_IN_FLIGHT, fetch=api_get):
+    """Fetches `path_of(item)` for every item with up to `workers` calls in flight.
+
+    Yields (item, result, error) in completion order, error being None on success. New calls are
+    only started as results are consumed, so a slow consumer (e.g. the db writer) holds back the
+    fetchers instead of piling up responses in memory.
+    """
+    items = list(items)
+    it = iter(items)
+    done = 0
+    last_report = time.monotonic()
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {}
+
+        def submit():
+            for item in it:
+                pending[executor.submit(fetch, path_of(item))] = item
+                return
+
+        for _ in range(workers):
+            submit()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                item = pending.pop(future)
+                try:
+                    result, error = future.result(), None
+                except Exception as e:
+                    result, error = None, e
+                yield item, result, error
+                done += 1
+                submit()
+
+            if time.monotonic() - last_report > REPORT_EVERY:
+                last_report = time.monotonic()
+                print(f'[{done}/{len(items)} done]')
+                print(stats.report())
+                print('  limiter:', limiter.report())
@@ -0,0 +1,106 @@
+"""End-to-end benchmark on a synthetic dataset.
+
+    python -m cfa.bench --users 20000 --contests 300
+
+generates the dataset (once per seed and size), then times ingest, achievement generation and
+building and saving documents. A record with the timings, row counts, parameters and git commit
+is appended to a JSON lines file so runs of different versions can be compared.
+"""
+import argparse
+import contextlib
+import datetime as dt
+import io
+import json
+import os
+import subprocess
+import time
+
+from . import cosmos, download, generate, models, synth
+from .sinks import FakeCosmosSink
+
+# High enough that saving measures the pipeline rather than the throughput limit
+SAVE_RU_PER_SEC = 1e7
+
+
+def run(users: int = 10000, contests: int = 200, seed: int = 0, workdir: str = 'bench',
+        results_path: str = 'bench_results.jsonl', workers: int = 1,
+        verbose: bool = False) -> dict:
+    cache_dir = os.path.join(workdir, f'cache-{users}-{contests}-{seed}')
+    db_path = os.path.join(workdir, 'bench.db')
+    os.makedirs(workdir, exist_ok=True)
+    for path in [db_path, db_path + '-wal', db_path + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+
+    timings = {}
+    out = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with out:
+        if not os.path.exists(cache_dir):
+            start = time.monotonic()
+            synth.generate(cache_dir, users=users, contests=contests, seed=seed)
+            timings['synth'] = time.monotonic() - start
+
+        start = time.monotonic()
+        stage_timings = download.main(db_path, cache_dir=cache_dir, offline=True, bulk=True)
+        timings['ingest'] = time.monotonic() - start
+        timings.update({'ingest.' + name: elapsed for name, elapsed in stage_timings.items()})
+
+        start = time.monotonic()
+        achievements = generate.get_achievements(db_path, workers=workers, use_cache=False)
+        timings['generate'] = time.monotonic() - start
+
+        start = time.monotonic()
+        docs = sum(1 for _ in cosmos.iter_docs(achievements))
+        timings['build_docs'] = time.monotonic() - start
+
+        start = time.monotonic()
+        cosmos.save(achievements, FakeCosmosSink(ru_per_sec=SAVE_RU_PER_SEC),
+                    ru_per_sec=SAVE_RU_PER_SEC)
+        timings['save'] = time.monotonic() - start
+
+    counts = {model.__name__: model.select().count() for model in [
+        models.User, models.Contest, models.Problem, models.Submission, models.Hack,
+        models.RanklistRow, models.ProblemResult, models.RatingChange]}
+    counts['docs'] = docs
+    counts['grants'] = sum(len(a.grants) for a in achievements)
+    models.close()
+
+    record = {
+        'time': dt.datetime.utcnow().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'params': dict(users=users, contests=contests, seed=seed, workers=workers),
+        'timings': {name: round(elapsed, 3) for name, elapsed in timings.items()},
+        'counts': counts,
+    }
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark on a synthetic dataset')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--contests', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--workdir', default='bench')
+    parser.add_argument('--results', default='bench_results.jsonl')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    record = run(args.users, args.contests, args.seed, args.workdir, args.results, args.workers,
+                 args.verbose)
+    for name, elapsed in record['timings'].items():
+        print(f'{name:>24} {elapsed:8.2f}s')
+    print(record['counts'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import gzip
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import BinaryIO, Iterable, List, Optional
+from urllib.parse import quote, unquote
+
+DEFAULT_MAX_BYTES = 50 << 30
+COMPRESS_LEVEL = 6
+_OK_PREFIX = re.compile(rb'\s*\{\s*"status"\s*:\s*"OK"')
+# Evict down to this fraction of the limit so that not every write has to evict
+EVICT_TO = 0.9
+
+
+class ResponseCache:
+    """Successful raw API responses stored gzipped on disk, one file per call.
+
+    Files are laid out as <root>/<endpoint>/<sorted params>.json.gz, e.g.
+    cache/contest.status/contestId=1.json.gz, so the cache can also be used as a dataset. When the
+    total size goes over `max_bytes` the least recently used files are removed.
+    """
+
+    def __init__(self, root: str = 'cache', max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = sum(f.stat().st_size for f in self._files())
+
+    def _files(self):
+        return self.root.glob('*/*.json.gz')
+
+    def file_for(self, path: str) -> Path:
+        endpoint, _, params = path.partition('?')
+        name = ','.join(sorted(params.split('&'))) if params else '_'
+        return self.root / endpoint / (quote(name, safe='=,') + '.json.gz')
+
+    def calls(self, endpoint: str) -> List[str]:
+        """The paths of the cached calls to an endpoint."""
+        paths = []
+        for file in (self.root / endpoint).glob('*.json.gz'):
+            name = unquote(file.name[:-len('.json.gz')])
+            paths.append(endpoint if name == '_' else f'{endpoint}?{name.replace(",", "&")}')
+        return sorted(paths)
+
+    def move(self, path: str, new_path: str):
+        """Keeps the cached body of a call as that of another, replacing what that had."""
+        file, new_file = self.file_for(path), self.file_for(new_path)
+        with self.lock:
+            if new_file.exists():
+                self.size -= new_file.stat().st_size
+            os.replace(file, new_file)
+
+    def remove(self, path: str):
+        file = self.file_for(path)
+        with self.lock:
+            if file.exists():
+                self.size -= file.stat().st_size
+                file.unlink()
+
+    def open(self, path: str) -> Optional[BinaryIO]:
+        """Returns the cached body of a call open for reading, or None if it isn't cached."""
+        file = self.file_for(path)
+        try:
+            fp = gzip.open(file, 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(file)
+        return fp
+
+    def put(self, path: str, body: bytes):
+        self._commit(path, self._write([body]))
+
+    def put_stream(self, path: str, chunks: Iterable[bytes]) -> BinaryIO:
+        """Writes a body to the cache as it arrives, returning it open for reading.
+
+        Bodies of failed calls are returned but not kept.
+        """
+        tmp = self._write(chunks)
+        fp = gzip.open(tmp, 'rb')
+        if _OK_PREFIX.match(fp.peek(64)):
+            self._commit(path, tmp)
+        else:
+            os.remove(tmp)  # fp stays readable
+        return fp
+
+    def _write(self, chunks: Iterable[bytes]) -> str:
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with open(fd, 'wb') as raw, \
+                    gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=COMPRESS_LEVEL) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except Exception:
+            os.remove(tmp)
+            raise
+        return tmp
+
+    def _commit(self, path: str, tmp: str):
+        file = self.file_for(path)
+        file.parent.mkdir(exist_ok=True)
+        with self.lock:
+            old_size = file.stat().st_size if file.exists() else 0
+            os.replace(tmp, file)
+            self.size += file.stat().st_size - old_size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = sorted(((f.stat().st_mtime, f) for f in self._files()), key=lambda x: x[0])
+        for _, f in files:
+            if self.size <= self.max_bytes * EVICT_TO:
+                break
+            self.size -= f.stat().st_size
+            f.unlink()
@@ -1,84 +1,256 @@
-import os
+import hashlib
+import json
+import re
+import threading
 import time
-from dataclasses import dataclass, asdict, field
-from collections import defaultdict, deque
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Iterator, List
 
-from azure.cosmos import CosmosClient
+from peewee import chunked
 
+from . import models
 from .achievement import AchievementWithStats
+from .models import UploadedDocument
+from .ratelimit import RateLimiter
+from .sinks import Sink, CosmosSink, Throttled
 
-# 400 requests units per second free, let's say we save at most 200 times per sec
-COSMOS_DB_RATE_PER_SEC = 200
+# Free tier gives 400 request units per second
+COSMOS_DB_RU_PER_SEC = 400
+UPLOAD_WORKERS = 8
+UPLOAD_ATTEMPTS = 5
+HASH_FLUSH_EVERY = 1000
+# Cosmos DB items can be at most 2 MB
+MAX_DOC_BYTES = 1_500_000
+# Handles can't contain '~', so this can't clash with a user's document
+METADATA_DOC_ID = '~achievements'
 
 
-@dataclass
-class Achievement:
-    title: str
-    brief: str
-    description: str
-    users_awarded: int
-    users_awarded_fraction: float
-    grant_infos: List[str] = field(default_factory=list)
+def save(achievements: List[AchievementWithStats], sink: Sink = None,
+         ru_per_sec: float = COSMOS_DB_RU_PER_SEC):
+    """Upserts the documents from iter_docs, skipping those unchanged since the last upload to
+    Cosmos DB when writing there. Documents uploaded before but not made anymore, e.g. of users
+    who lost all their grants, are deleted from Cosmos DB too; other sinks keep them.
 
+    Uploads run concurrently, paced by their request unit charges, and back off when throttled.
+    Documents go to Cosmos DB unless another sink is given, e.g. a FakeCosmosSink to try things
+    out locally. Other sinks get every document and don't touch the upload hashes, so that they
+    don't make the next real upload skip documents.
+    """
+    sink = sink or CosmosSink()
+    UploadedDocument.create_table()
+    stored = {}
+    if sink.skip_unchanged:
+        stored = dict(UploadedDocument.select(UploadedDocument.id, UploadedDocument.hash).tuples())
+    skipped = 0
 
-@dataclass
-class User:
-    id: str
-    achievements: List[Achievement] = field(default_factory=list)
+    throttle = AdaptiveThrottle(ru_per_sec)
+    written, failed, uploaded = 0, 0, []
+    made = set()
+    now = time.monotonic()
 
+    def flush():
+        with models.db.atomic():
+            for piece in chunked(uploaded, 5000):
+                (UploadedDocument
+                 .insert_many(piece, fields=[UploadedDocument.id, UploadedDocument.hash])
+                 .on_conflict_replace()
+                 .execute())
+        uploaded.clear()
 
-def save(achievements: List[AchievementWithStats]):
-    dicts = to_user_dicts(achievements)
-    print(dicts[0])
-    limiter = RateLimiter(COSMOS_DB_RATE_PER_SEC, 1)
-    container = get_client()
-    now = time.monotonic()
-    for dict_ in dicts:
-        limiter.wait()
-        # container.upsert_item(dict_)
-    print('saved', len(dicts), time.monotonic() - now)
-
-def get_client() -> CosmosClient:
-    conn_str = os.environ['AZURE_COSMOS_CONN_STRING']
-    client = CosmosClient.from_connection_string(conn_str=conn_str)
-    database = client.get_database_client('database1')
-    container = database.get_container_client('container2')
-    return container
-
-def to_user_dicts(achievements: List[AchievementWithStats]) -> List[User]:
-    dicts = {}
-    for achievement_with_stats in achievements:
-        dicts1 = {}
+    def collect(futures):
+        nonlocal written, failed
+        for future in futures:
+            id_, hash_ = futures_docs.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                print('failed', id_, e)
+                failed += 1
+                continue
+            written += 1
+            if sink.skip_unchanged:
+                uploaded.append((id_, hash_))
+        if len(uploaded) >= HASH_FLUSH_EVERY:
+            flush()
+
+    futures_docs = {}
+    with ThreadPoolExecutor(UPLOAD_WORKERS) as executor:
+        for dict_ in iter_docs(achievements):
+            made.add(dict_['id'])
+            hash_ = doc_hash(dict_)
+            if stored.get(dict_['id']) == hash_:
+                skipped += 1
+                continue
+            future = executor.submit(upload, sink, dict_, throttle)
+            futures_docs[future] = (dict_['id'], hash_)
+            if len(futures_docs) >= UPLOAD_WORKERS * 4:
+                done, _ = wait(futures_docs, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(futures_docs))
+        flush()
+
+        stale = [id_ for id_ in stored if id_ not in made]
+        futures = {executor.submit(delete, sink, id_, throttle): id_ for id_ in stale}
+        deleted = []
+        for future, id_ in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print('failed to delete', id_, e)
+                failed += 1
+                continue
+            deleted.append(id_)
+        with models.db.atomic():
+            for piece in chunked(deleted, 5000):
+                UploadedDocument.delete().where(UploadedDocument.id.in_(piece)).execute()
+    sink.close()
+
+    print('written', written, 'skipped', skipped, 'deleted', len(deleted),
+          'throttled', throttle.throttled_count, 'failed', failed,
+          f'{time.monotonic() - now:.2f}s')
+    print('limiter:', throttle.limiter.report())
+
+def upload(sink: Sink, dict_, throttle: 'AdaptiveThrottle'):
+    _paced(lambda: sink.upsert(dict_), throttle)
+
+def delete(sink: Sink, id_: str, throttle: 'AdaptiveThrottle'):
+    _paced(lambda: sink.delete(id_), throttle)
+
+def _paced(write: Callable[[], float], throttle: 'AdaptiveThrottle'):
+    for attempt in range(UPLOAD_ATTEMPTS):
+        expected = throttle.wait()
+        try:
+            charge = write()
+        except Throttled as e:
+            if attempt == UPLOAD_ATTEMPTS - 1:
+                raise
+            throttle.throttled(e.retry_after)
+            continue
+        throttle.record(expected, charge)
+        return
+
+def doc_hash(dict_) -> str:
+    content = json.dumps(dict_, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def achievement_id(title: str) -> str:
+    """A readable id from the title, with a hash of the exact title so that titles differing only
+    in case, punctuation or non-ASCII characters, like C++ Master and C Master, still differ."""
+    slug = re.sub('[^a-z0-9]+', '-', title.lower()).strip('-')
+    return f'{slug}-{hashlib.sha256(title.encode()).hexdigest()[:8]}'
+
+def iter_docs(achievements: List[AchievementWithStats],
+              max_doc_bytes: int = MAX_DOC_BYTES) -> Iterator[dict]:
+    """Yields the metadata document, then the documents of each user one at a time.
+
+    Achievement metadata is only in the metadata document; user documents refer to achievements
+    by id. A user whose document would be larger than `max_doc_bytes` gets it split into parts
+    with ids handle, handle~1, handle~2, ..., the first recording the number of parts.
+    """
+    ids = [achievement_id(a.achievement.title) for a in achievements]
+    if len(set(ids)) != len(ids):
+        duplicates = sorted(id_ for id_, count in Counter(ids).items() if count > 1)
+        raise ValueError(f'achievement ids {duplicates} are not unique')
+
+    yield {
+        'id': METADATA_DOC_ID,
+        'achievements': [
+            {
+                'id': id_,
+                'title': a.achievement.title,
+                'brief': a.achievement.brief,
+                'description': a.achievement.description,
+                'icon_name': a.achievement.icon_name,
+                'users_awarded': a.users_awarded,
+                'users_awarded_fraction': a.users_awarded_fraction,
+            }
+            for id_, a in zip(ids, achievements)
+        ],
+    }
+
+    # Only (achievement index, info) pairs are kept per user until their document is built
+    by_user: Dict[str, List[tuple]] = defaultdict(list)
+    for i, achievement_with_stats in enumerate(achievements):
         for grant in achievement_with_stats.grants:
-            if grant.handle not in dicts1:
-                dicts1[grant.handle] = Achievement(
-                                            achievement_with_stats.achievement.title,
-                                            achievement_with_stats.achievement.brief,
-                                            achievement_with_stats.achievement.description,
-                                            achievement_with_stats.users_awarded,
-                                            achievement_with_stats.users_awarded_fraction)
-            dicts1[grant.handle].grant_infos.append(grant.info)
-
-        for handle, ach in dicts1.items():
-            if handle not in dicts:
-                dicts[handle] = User(handle)
-            dicts[handle].achievements.append(ach)
-
-    return list(map(asdict, dicts.values()))
-
-
-class RateLimiter:
-    def __init__(self, times: int, per: float):
-        self.times = times
-        self.per = per
-        self.past = deque(maxlen=self.times)
-
-    def wait(self):
-        now = time.monotonic()
-        if len(self.past) == self.times:
-            until = self.past[0] + self.per
-            if until > now:
-                time.sleep(until - now)
-            self.past.popleft()
-        self.past.append(now)
+            by_user[grant.handle].append((i, grant.info))
+
+    for handle in list(by_user):
+        infos = defaultdict(list)
+        for i, info in by_user.pop(handle):
+            infos[i].append(info)
+        entries = [{'id': ids[i], 'grant_infos': grant_infos} for i, grant_infos in infos.items()]
+        yield from _split_doc(handle, entries, max_doc_bytes)
+
+def _split_doc(handle: str, entries: List[dict], max_doc_bytes: int) -> Iterator[dict]:
+    budget = max_doc_bytes - 1000  # room for the id and part fields
+    parts, part, size = [], [], 0
+    for entry in _split_entries(entries, budget):
+        entry_size = _json_size(entry)
+        if part and size + entry_size > budget:
+            parts.append(part)
+            part, size = [], 0
+        part.append(entry)
+        size += entry_size
+    parts.append(part)
+
+    for i, part in enumerate(parts):
+        doc = {'id': handle if i == 0 else f'{handle}~{i}', 'achievements': part}
+        if len(parts) > 1:
+            doc['user'] = handle
+            doc['part'] = i
+            if i == 0:
+                doc['parts'] = len(parts)
+        yield doc
+
+def _split_entries(entries: List[dict], budget: int) -> Iterator[dict]:
+    """Spreads the grant infos of entries larger than the budget over several entries."""
+    for entry in entries:
+        size = _json_size(entry)
+        if size <= budget:
+            yield entry
+            continue
+        infos = entry['grant_infos']
+        step = -(-len(infos) // (size // budget + 1))
+        for j in range(0, len(infos), step):
+            yield {'id': entry['id'], 'grant_infos': infos[j:j + step]}
+
+def _json_size(obj) -> int:
+    return len(json.dumps(obj, separators=(',', ':')).encode())
+
+
+class AdaptiveThrottle:
+    """Paces calls by their request unit charge with a RateLimiter, adapting to throttling.
+
+    The rate starts at `max_rate` RU/s, is halved whenever a call gets a 429 and creeps back up
+    by `step` RU/s (by default 1% of `max_rate`) with every successful call. Each call takes the
+    expected charge, a moving average of actual charges, and is settled up once its charge is
+    known.
+    """
+
+    def __init__(self, max_rate: float, min_rate: float = 10, step: float = None):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.step = step or max_rate / 100
+        self.limiter = RateLimiter(max_rate, burst=max_rate)
+        self.expected_charge = 10.0
+        self.throttled_count = 0
+        self.lock = threading.Lock()
+
+    def wait(self) -> float:
+        """Waits for the expected charge of a call and returns it."""
+        expected = self.expected_charge
+        self.limiter.acquire(expected)
+        return expected
+
+    def record(self, expected: float, charge: float):
+        self.limiter.charge(charge - expected)
+        with self.lock:
+            self.expected_charge = 0.9 * self.expected_charge + 0.1 * charge
+            self.limiter.set_rate(min(self.max_rate, self.limiter.rate + self.step))
+
+    def throttled(self, retry_after: float):
+        with self.lock:
+            self.throttled_count += 1
+            self.limiter.set_rate(max(self.min_rate, self.limiter.rate / 2))
+        self.limiter.pause(retry_after)
@@ -1,97 +1,34 @@
-# %%
+import contextlib
 import datetime as dt
-
-# from . import models
-import models
-from models import User, Contest, Problem, ContestProblem, Submission, Hack, RanklistRow, RatingChange, ProblemResult, ParticipantType
-from peewee import chunked
-
-# %%
-models.init('cf.db')
-models.connect()
-models.create_tables()
-
-# %%
+import functools
+import itertools
 import time
-import requests
-API_BASE = 'https://codeforces.com/api/'
-
-last = 0
-cooldown = 1
-
-def api_get(path):
-    global last
-    wait = last + cooldown - time.time()
-    if wait > 0:
-        time.sleep(wait)
-    r = requests.get(API_BASE + path)
-    j = r.json()
-    last = time.time()
-    if 'result' in j:
-        return j['result']
-    raise Exception(j)
-
-# %%
-user_list = api_get('user.ratedList?activeOnly=false')
-print(len(user_list), 'rated users')
-
-# %%
-to_insert, to_update = [], []
-for u in user_list:
-    try:
-        user = User.get(User.handle == u['handle'])
-        user.contribution = u['contribution']
-        user.rank = u['rank']
-        user.rating = u['rating']
-        user.max_rank = u['maxRank']
-        user.max_rating = u['maxRating']
-        user.last_online_time = dt.datetime.utcfromtimestamp(u['lastOnlineTimeSeconds'])
-        user.registration_time = dt.datetime.utcfromtimestamp(u['registrationTimeSeconds'])
-        user.friend_of_count = u['friendOfCount']
-        to_update.append(user)
-    except User.DoesNotExist:
-        to_insert.append(dict(
-            handle=u['handle'],
-            contribution=u['contribution'],
-            rank=u['rank'],
-            rating=u['rating'],
-            max_rank=u['maxRank'],
-            max_rating=u['maxRating'],
-            last_online_time=dt.datetime.utcfromtimestamp(u['lastOnlineTimeSeconds']),
-            registration_time=dt.datetime.utcfromtimestamp(u['registrationTimeSeconds']),
-            friend_of_count=u['friendOfCount'],
-        ))
-
-# %%
-with models.db.atomic():
-    for piece in chunked(to_insert, 10000):
-        User.insert_many(piece).execute()
-    User.bulk_update(
-        to_update,
-        [User.contribution, User.rank, User.rating, User.max_rank, User.max_rating,
-             User.last_online_time, User.registration_time, User.friend_of_count],
-        batch_size=10000)
-
-print(User.select().count(), 'users in db')
-
-# %%
-contest_list = api_get('contest.list')
-data = []
-for c in contest_list:
-    data.append(dict(
-        id=c['id'],
-        name=c['name'],
-        start_time=dt.datetime.utcfromtimestamp(c['startTimeSeconds']),
-    ))
-Contest.insert_many(data).on_conflict_ignore().execute()
-
-print(Contest.select().count(), 'contests in db')
-
-# %%
-done = set()
-
-# %%
-known = [
+from typing import Dict, Iterable, List, Tuple
+from urllib.parse import parse_qs
+
+from peewee import chunked, fn
+
+from . import models
+from .models import User, Contest, Problem, ContestProblem, Submission, Hack, RanklistRow, RatingChange, ProblemResult, ParticipantType, SyncState, ChangedUser, ChangedContest
+from .models import FailedRequest
+from .models import ProgrammingLanguage, Testset, Tag, ProblemTag, UserStats
+from . import aggregates, api, migrate, shard
+from .api import api_get, fetch_all
+from .cache import ResponseCache
+from .lookup import Lookup
+
+SUBMISSION_CHUNK_SIZE = 20000
+# Submissions per contest.status call when fetching only the newest ones
+SUBMISSION_PAGE_SIZE = 1000
+# Contests without rating changes this long after the start are taken to be unrated
+RATING_CHANGES_GRACE = dt.timedelta(days=7)
+# Rows per user upsert, kept under SQLite's default limit of 32766 bound variables
+USER_BATCH_SIZE = 3000
+# Contests that failed in this many runs are left for --retry-failed
+MAX_FAILED_RUNS = 3
+
+# (contest, handle) pairs with broken standings rows
+KNOWN_BAD_STANDINGS = (
     (158, 'r_hero'),
     (158, 'hashlife'),
     (172, 'pepela'),
@@ -103,155 +40,10 @@ known = [
     (615, 'mohamedazab'),
     (615, 'Altitude'),
     (616, 'shankhs'),
-]
-for c in Contest.select():
-    if c.id in done or ContestProblem.select().where(ContestProblem.contest == c).exists():
-        continue
-
-    done.add(c.id)
-    with models.db.atomic():
-        print('contest', c.id, c.name)
-        try:
-            j = api_get('contest.standings?contestId=%s' % c.id)
-        except Exception as e:
-            print(e)
-            print()
-            continue
-
-        problems = j['problems']
-        rows = j['rows']
-
-        data = []
-        for p in problems:
-            data.append(dict(
-                name=p['name'],
-                contest_start_time=c.start_time,
-                rating=p.get('rating'),
-                tags=p['tags'],
-            ))
-        rc = Problem.insert_many(data).on_conflict_ignore().execute()
-        print(rc, 'problems')
-
-        data = []
-        for p in problems:
-            data.append(dict(
-                contest=c,
-                problem=Problem.get(
-                    Problem.name == p['name'], Problem.contest_start_time == c.start_time),
-                index=p['index'],
-            ))
-        rc = ContestProblem.insert_many(data).execute()
-        print(rc, 'contest problems')
-
-        users_seen = set()
-        data = []
-        data_pr = []
-        for r in rows:
-            party = r['party']
-            if len(party['members']) > 1:
-                continue  # Skip teams
-            handle = party['members'][0]['handle']
-            if (c.id, handle) in known:
-                continue
-            if handle in users_seen:
-                raise Exception(c.id, handle)
-
-            users_seen.add(handle)
-            try:
-                user = User.get(User.handle == handle)
-            except User.DoesNotExist:
-                # user participated in this unrated contest and never in another rated contest
-                # skip i guess
-                print('skipping user', handle)
-                continue
-
-            participant_type = ParticipantType[party['participantType']]
-            assert participant_type == ParticipantType.CONTESTANT
-            data.append(dict(
-                contest=c,
-                user=user,
-                participant_type=participant_type.value,
-                rank=r['rank'],
-                points=r['points'],
-                penalty=r['penalty'],
-                successful_hack_count=r['successfulHackCount'],
-                unsuccessful_hack_count=r['unsuccessfulHackCount'],
-            ))
-            for p, pr in zip(problems, r['problemResults']):
-                if pr['points'] == 0 and pr['rejectedAttemptCount'] == 0:
-                    # no attempt
-                    continue
-                data_pr.append(dict(
-                    contest=c,
-                    user=user,
-                    problem_index=p['index'],
-                    points=pr['points'],
-                    penalty=pr.get('penalty', 0),
-                    rejected_attempt_count=pr['rejectedAttemptCount'],
-                    best_submission_time_seconds=pr.get('bestSubmissionTimeSeconds', 0),
-                ))
-
-
-        rc = RanklistRow.insert_many(data).execute()
-        print(rc, 'ranklist rows')
-
-        for piece in chunked(data_pr, 10000):
-            rc = ProblemResult.insert_many(piece).execute()
-        print(rc, 'problem result rows')
-
-        print('')
-
-# %%
-done = set()
-
-# %%
-for c in Contest.select():
-    if c.id in done or Hack.select().where(Hack.contest_id == c.id).exists():
-        continue
-
-    done.add(c.id)
-    print('contest', c.id, c.name)
-    try:
-        hacks = api_get('contest.hacks?contestId=%s' % c.id)
-    except Exception as e:
-        print(e)
-        print()
-        continue
-
-    data = []
-    for h in hacks:
-        hacker = h['hacker']['members']
-        defender = h['defender']['members']
-        if len(hacker) > 1 or len(defender) > 1:
-            continue  # Skip teams
-        try:
-            hacker = User.get(User.handle == hacker[0]['handle'])
-            defender = User.get(User.handle == defender[0]['handle'])
-        except User.DoesNotExist:
-            # hacker or defender is not rated
-            # example "md5" in contest 21 Codeforces Alpha Round #21 (Codeforces format)
-            continue
-        data.append(dict(
-            id=h['id'],
-            contest=c,
-            problem=ContestProblem.get(
-                ContestProblem.contest == c.id,
-                ContestProblem.index == h['problem']['index']),
-            hacker=hacker,
-            defender=defender,
-            verdict=Hack.Verdict[h['verdict']].value,
-        ))
-
-    rc = Hack.insert_many(data).execute()
-    print(rc, 'hacks')
-    print('')
-
-# %%
-done = set()
-
-# %%
+)
 
-known = (
+# (contest, handle) pairs with duplicated rating changes
+KNOWN_DUPLICATE_RATING_CHANGES = (
     (447, 'kasim'),
     (472, 'a00920'),
     (472, 'yuki2006'),
@@ -262,103 +54,768 @@ known = (
     (615, "mohamedazab"),
 )
 
-for c in Contest.select():
-    if c.id in done or RatingChange.select().where(RatingChange.contest == c).exists():
-        continue
 
-    print('contest', c.id, c.name)
-    done.add(c.id)
-    try:
-        changes = api_get('contest.ratingChanges?contestId=%s' % c.id)
-    except Exception as e:
-        print(e)
-        print()
-        continue
-
-    seen = set()
+# Tables written with the data of each contest endpoint
+ENDPOINT_MODELS = {
+    'contest.standings': [Problem, Tag, ProblemTag, ContestProblem, RanklistRow, ProblemResult],
+    'contest.hacks': [Hack],
+    'contest.ratingChanges': [RatingChange],
+    'contest.status': [Submission, ProgrammingLanguage, Testset],
+}
+
+USER_FIELDS = [
+    User.handle, User.contribution, User.rank, User.rating, User.max_rank, User.max_rating,
+    User.last_online_time, User.registration_time, User.friend_of_count]
+
+
+def download_users(lookup: Lookup):
+    """Syncs rated users, writing only new or changed rows with INSERT ... ON CONFLICT UPDATE."""
+    user_list = api_get('user.ratedList?activeOnly=false')
+    print(len(user_list), 'rated users')
+
+    stored = {row[0]: row for row in User.select(*USER_FIELDS).tuples()}
+    to_write = []
+    inserted = updated = unchanged = 0
+    for u in user_list:
+        row = (
+            u['handle'],
+            u['contribution'],
+            u['rank'],
+            u['rating'],
+            u['maxRank'],
+            u['maxRating'],
+            dt.datetime.utcfromtimestamp(u['lastOnlineTimeSeconds']),
+            dt.datetime.utcfromtimestamp(u['registrationTimeSeconds']),
+            u['friendOfCount'],
+        )
+        old = stored.get(u['handle'])
+        if old is None:
+            inserted += 1
+        elif old != row:
+            updated += 1
+        else:
+            unchanged += 1
+            continue
+        to_write.append(row)
+    del stored
 
+    with models.db.atomic():
+        for piece in chunked(to_write, USER_BATCH_SIZE):
+            (User
+             .insert_many(piece, fields=USER_FIELDS)
+             .on_conflict(conflict_target=[User.handle], preserve=USER_FIELDS[1:])
+             .execute())
+        lookup.load_users()
+        # Record changed users for incremental generation
+        data = [(lookup.user_ids[row[0]],) for row in to_write]
+        for piece in chunked(data, 10000):
+            ChangedUser.insert_many(piece, fields=[ChangedUser.user]).on_conflict_ignore().execute()
+        if to_write:
+            models.touch(User)
+
+    print(inserted, 'inserted', updated, 'updated', unchanged, 'unchanged')
+    print(User.select().count(), 'users in db')
+
+
+def download_contests() -> Dict[int, str]:
+    """Adds new contests and returns the current phase of every contest."""
+    contest_list = api_get('contest.list')
     data = []
-    for d in changes:
-        if d['handle'] in seen:
-            if (c.id, d['handle']) in known:
-                continue
-        seen.add(d['handle'])
+    for c in contest_list:
         data.append(dict(
-            contest=c,
-            user=User.get(User.handle == d['handle']),
-            rank=d['rank'],
-            old_rating=d['oldRating'],
-            new_rating=d['newRating'],
-            update_time=dt.datetime.utcfromtimestamp(d['ratingUpdateTimeSeconds']),
+            id=c['id'],
+            name=c['name'],
+            start_time=dt.datetime.utcfromtimestamp(c['startTimeSeconds']),
         ))
+    before = Contest.select().count()
+    Contest.insert_many(data).on_conflict_ignore().execute()
+    after = Contest.select().count()
+    if after != before:
+        models.touch(Contest)
+
+    print(after, 'contests in db')
+    return {c['id']: c['phase'] for c in contest_list}
+
+
+def mark_synced(contest: Contest, endpoint: str, finished: bool, max_submission_id: int = None,
+                changed: bool = True):
+    """Records a fetch, and unless nothing was written, the contest change for incremental
+    generation and the aggregates."""
+    if changed:
+        ChangedContest.insert(contest=contest).on_conflict_ignore().execute()
+        models.touch(*ENDPOINT_MODELS[endpoint])
+        # Bulk loads drop the indexes these need, and rebuild the aggregates at the end instead
+        if not models.in_bulk_load():
+            aggregates.update_contest(contest.id, endpoint)
+    (SyncState
+     .insert(contest=contest, endpoint=endpoint, fetched_at=dt.datetime.utcnow(),
+             contest_finished=finished, max_submission_id=max_submission_id)
+     .on_conflict(
+         conflict_target=[SyncState.contest, SyncState.endpoint],
+         preserve=[SyncState.fetched_at, SyncState.contest_finished,
+                   SyncState.max_submission_id])
+     .execute())
+    (FailedRequest
+     .delete()
+     .where(FailedRequest.contest == contest, FailedRequest.endpoint == endpoint)
+     .execute())
+
+
+def queue_failure(contest: Contest, endpoint: str, path: str, error: Exception):
+    """Records in the retry queue that the contest data from an endpoint couldn't be fetched or
+    written, api having already retried transient failures. A contest that hasn't started yet
+    isn't queued, as it will be fetched once it has."""
+    print(error)
+    print()
+    if isinstance(error, api.ApiError) and error.not_started:
+        return
+    (FailedRequest
+     .insert(contest=contest, endpoint=endpoint, path=path, error=str(error)[:1000], attempts=1,
+             failed_at=dt.datetime.utcnow())
+     .on_conflict(
+         conflict_target=[FailedRequest.contest, FailedRequest.endpoint],
+         preserve=[FailedRequest.path, FailedRequest.error, FailedRequest.failed_at],
+         update={FailedRequest.attempts: FailedRequest.attempts + 1})
+     .execute())
+
+
+def failed_runs(endpoint: str) -> Dict[int, int]:
+    """Contest id to the number of runs that failed to sync it from the endpoint."""
+    return dict(FailedRequest
+                .select(FailedRequest.contest, FailedRequest.attempts)
+                .where(FailedRequest.endpoint == endpoint)
+                .tuples())
+
+
+def skip_failed(contests: List[Contest], endpoint: str, retry_failed: bool) -> List[Contest]:
+    """With `retry_failed`, only the contests in the retry queue for the endpoint, otherwise all
+    but those that failed MAX_FAILED_RUNS times, so that every run doesn't spend calls on them."""
+    failed = failed_runs(endpoint)
+    if retry_failed:
+        return [c for c in contests if c.id in failed]
+    skipped = [c for c in contests if failed.get(c.id, 0) >= MAX_FAILED_RUNS]
+    if skipped:
+        print(len(skipped), 'contests skipped after failing', MAX_FAILED_RUNS,
+              'times, run with --retry-failed to try them again')
+    return [c for c in contests if failed.get(c.id, 0) < MAX_FAILED_RUNS]
+
+
+def was_synced(contest: Contest, endpoint: str) -> bool:
+    return (SyncState
+            .select()
+            .where(SyncState.contest == contest, SyncState.endpoint == endpoint)
+            .exists())
+
+
+def started(contests: List[Contest], phases: Dict[int, str]) -> List[Contest]:
+    """Leaves out contests that haven't started, for which the contest endpoints fail."""
+    return [c for c in contests if phases.get(c.id) != 'BEFORE']
+
+
+def contests_to_sync(endpoint: str, phases: Dict[int, str], incremental: bool,
+                     retry_failed: bool = False) -> List[Contest]:
+    """Contests never fetched from the endpoint, plus in incremental mode those that were still
+    running when last fetched, filtered by started and skip_failed."""
+    states = {
+        contest_id: finished
+        for contest_id, finished in (SyncState
+                                     .select(SyncState.contest, SyncState.contest_finished)
+                                     .where(SyncState.endpoint == endpoint)
+                                     .tuples())}
+    todo = [c for c in Contest.select()
+            if c.id not in states or (incremental and not states[c.id])]
+    return skip_failed(started(todo, phases), endpoint, retry_failed)
+
+
+def backfill_sync_state():
+    """Marks contests that already have data as synced, for databases downloaded before the
+    sync state existed."""
+    now = dt.datetime.utcnow()
+    queries = [
+        ('contest.standings', ContestProblem.select(ContestProblem.contest).distinct()),
+        ('contest.hacks', Hack.select(Hack.contest).distinct()),
+        ('contest.ratingChanges', RatingChange.select(RatingChange.contest).distinct()),
+    ]
+    with models.db.atomic():
+        for endpoint, query in queries:
+            data = [dict(contest=contest_id, endpoint=endpoint, fetched_at=now,
+                         contest_finished=True)
+                    for contest_id, in query.tuples()]
+            for piece in chunked(data, 5000):
+                SyncState.insert_many(piece).on_conflict_ignore().execute()
+        query = (Submission
+                 .select(Submission.contest, fn.MAX(Submission.id))
+                 .group_by(Submission.contest))
+        data = [dict(contest=contest_id, endpoint='contest.status', fetched_at=now,
+                     contest_finished=True, max_submission_id=max_id)
+                for contest_id, max_id in query.tuples()]
+        for piece in chunked(data, 5000):
+            SyncState.insert_many(piece).on_conflict_ignore().execute()
+
+
+def download_standings(lookup: Lookup, phases: Dict[int, str], incremental: bool = False,
+                          retry_failed: bool = False):
+    todo = contests_to_sync('contest.standings', phases, incremental, retry_failed)
+    path_of = lambda c: 'contest.standings?contestId=%s' % c.id
+    for c, j, err in fetch_all(todo, path_of):
+        print('contest', c.id, c.name)
+        if err is not None:
+            queue_failure(c, 'contest.standings', path_of(c), err)
+            continue
 
-    rc = RatingChange.insert_many(data).execute()
-    print(rc, 'rating changes')
-    print('')
+        with models.db.atomic():
+            problems = j['problems']
+            rows = j['rows']
+
+            if was_synced(c, 'contest.standings'):
+                # Replace the standings of a contest that was running when last fetched
+                RanklistRow.delete().where(RanklistRow.contest == c).execute()
+                ProblemResult.delete().where(ProblemResult.contest == c).execute()
+
+            data = []
+            for p in problems:
+                data.append(dict(
+                    name=p['name'],
+                    contest_start_time=c.start_time,
+                    rating=p.get('rating'),
+                ))
+            rc = Problem.insert_many(data).on_conflict_ignore().execute()
+            lookup.load_problems(c.start_time)
+            print(rc, 'problems')
+
+            data = [(lookup.problem_ids[p['name'], c.start_time], lookup.name_id(Tag, tag))
+                    for p in problems for tag in p['tags']]
+            if data:
+                (ProblemTag
+                 .insert_many(data, fields=[ProblemTag.problem, ProblemTag.tag])
+                 .on_conflict_ignore()
+                 .execute())
+
+            data = []
+            for p in problems:
+                data.append(dict(
+                    contest=c,
+                    problem=lookup.problem_ids[p['name'], c.start_time],
+                    index=p['index'],
+                ))
+            rc = ContestProblem.insert_many(data).on_conflict_ignore().execute()
+            lookup.load_contest_problems(c.id)
+            print(rc, 'contest problems')
+
+            users_seen = set()
+            data = []
+            data_pr = []
+            for r in rows:
+                party = r['party']
+                if len(party['members']) > 1:
+                    continue  # Skip teams
+                handle = party['members'][0]['handle']
+                if (c.id, handle) in KNOWN_BAD_STANDINGS:
+                    continue
+                if handle in users_seen:
+                    raise Exception(c.id, handle)
+
+                users_seen.add(handle)
+                user = lookup.user_ids.get(handle)
+                if user is None:
+                    # user participated in this unrated contest and never in another rated contest
+                    # skip i guess
+                    print('skipping user', handle)
+                    continue
 
-# %%
-done = set()
+                participant_type = ParticipantType[party['participantType']]
+                assert participant_type == ParticipantType.CONTESTANT
+                data.append(dict(
+                    contest=c,
+                    user=user,
+                    participant_type=participant_type.value,
+                    rank=r['rank'],
+                    points=r['points'],
+                    penalty=r['penalty'],
+                    successful_hack_count=r['successfulHackCount'],
+                    unsuccessful_hack_count=r['unsuccessfulHackCount'],
+                ))
+                for p, pr in zip(problems, r['problemResults']):
+                    if pr['points'] == 0 and pr['rejectedAttemptCount'] == 0:
+                        # no attempt
+                        continue
+                    data_pr.append(dict(
+                        contest=c,
+                        user=user,
+                        problem_index=p['index'],
+                        points=pr['points'],
+                        penalty=pr.get('penalty', 0),
+                        rejected_attempt_count=pr['rejectedAttemptCount'],
+                        best_submission_time_seconds=pr.get('bestSubmissionTimeSeconds', 0),
+                    ))
+
+            rc = RanklistRow.insert_many(data).execute()
+            print(rc, 'ranklist rows')
+
+            for piece in chunked(data_pr, 10000):
+                rc = ProblemResult.insert_many(piece).execute()
+            print(rc, 'problem result rows')
+
+            mark_synced(c, 'contest.standings', phases.get(c.id) == 'FINISHED')
+
+            print('')
+        models.checkpoint()
+
+
+def download_hacks(lookup: Lookup, phases: Dict[int, str], incremental: bool = False,
+                      retry_failed: bool = False):
+    todo = contests_to_sync('contest.hacks', phases, incremental, retry_failed)
+    path_of = lambda c: 'contest.hacks?contestId=%s' % c.id
+    for c, hacks, err in fetch_all(todo, path_of):
+        print('contest', c.id, c.name)
+        if err is not None:
+            queue_failure(c, 'contest.hacks', path_of(c), err)
+            continue
 
-# for efficiency
-user_map = {u.handle: u for u in User.select()}
+        try:
+            data = []
+            for h in hacks:
+                hacker = h['hacker']['members']
+                defender = h['defender']['members']
+                if len(hacker) > 1 or len(defender) > 1:
+                    continue  # Skip teams
+                hacker = lookup.user_ids.get(hacker[0]['handle'])
+                defender = lookup.user_ids.get(defender[0]['handle'])
+                if hacker is None or defender is None:
+                    # hacker or defender is not rated
+                    # example "md5" in contest 21 Codeforces Alpha Round #21 (Codeforces format)
+                    continue
+                data.append(dict(
+                    id=h['id'],
+                    contest=c,
+                    problem=lookup.contest_problem_ids[c.id, h['problem']['index']],
+                    hacker=hacker,
+                    defender=defender,
+                    verdict=Hack.Verdict[h['verdict']].value,
+                ))
 
-# %%
-for c in Contest.select():
-    if c.id in done or Submission.select().where(Submission.contest == c).exists():
-        continue
+            with models.db.atomic():
+                rc = Hack.insert_many(data).on_conflict_replace().execute()
+                mark_synced(c, 'contest.hacks', phases.get(c.id) == 'FINISHED')
+        except Exception as e:
+            # e.g. a problem missing as the contest's standings failed
+            queue_failure(c, 'contest.hacks', path_of(c), e)
+            continue
+        models.checkpoint()
+        print(rc, 'hacks')
+        print('')
 
-    print('contest', c.id, c.name)
-    done.add(c.id)
-    try:
-        subs = api_get('contest.status?contestId=%s' % c.id)
-    except Exception as e:
-        print(e)
-        print()
-        continue
-    print('got resp')
 
-    data = []
-    for s in subs:
-        party = s['author']
-        if len(party['members']) != 1:
-            continue # skip teams and ghosts
-        handle = party['members'][0]['handle']
+def download_rating_changes(lookup: Lookup, phases: Dict[int, str], incremental: bool = False,
+                               retry_failed: bool = False):
+    todo = contests_to_sync('contest.ratingChanges', phases, incremental, retry_failed)
+    path_of = lambda c: 'contest.ratingChanges?contestId=%s' % c.id
+    for c, changes, err in fetch_all(todo, path_of):
+        print('contest', c.id, c.name)
+        if err is not None:
+            queue_failure(c, 'contest.ratingChanges', path_of(c), err)
+            continue
+
         try:
-            author = user_map[handle]
-        except KeyError:
-            continue # not rated user
-        typ = ParticipantType[party['participantType']]
-        # if typ == ParticipantType.PRACTICE or typ == ParticipantType.VIRTUAL:
-        #     continue
-        data.append((
-            s['id'],
-            c,
-            ContestProblem.get(
-                ContestProblem.contest == c,
-                ContestProblem.index == s['problem']['index']),
-            author,
-            typ.value,
-            s['programmingLanguage'],
-            Submission.Verdict[s['verdict']].value,
-            s['testset'],
-            s['passedTestCount'],
-        ))
+            seen = set()
+
+            data = []
+            for d in changes:
+                if d['handle'] in seen:
+                    if (c.id, d['handle']) in KNOWN_DUPLICATE_RATING_CHANGES:
+                        continue
+                seen.add(d['handle'])
+                data.append(dict(
+                    contest=c,
+                    user=lookup.user_ids[d['handle']],
+                    rank=d['rank'],
+                    old_rating=d['oldRating'],
+                    new_rating=d['newRating'],
+                    update_time=dt.datetime.utcfromtimestamp(d['ratingUpdateTimeSeconds']),
+                ))
+
+            # Rating changes are published a while after the contest ends
+            finished = phases.get(c.id) == 'FINISHED' and (
+                data or c.start_time < dt.datetime.utcnow() - RATING_CHANGES_GRACE)
+            with models.db.atomic():
+                if was_synced(c, 'contest.ratingChanges'):
+                    RatingChange.delete().where(RatingChange.contest == c).execute()
+                rc = RatingChange.insert_many(data).execute()
+                mark_synced(c, 'contest.ratingChanges', finished)
+        except Exception as e:
+            # e.g. a user missing from the rated list fetched earlier
+            queue_failure(c, 'contest.ratingChanges', path_of(c), e)
+            continue
+        models.checkpoint()
+        print(rc, 'rating changes')
+        print('')
+
 
+SUBMISSION_FIELDS = [
+    Submission.id,
+    Submission.contest,
+    Submission.problem,
+    Submission.author,
+    Submission.type,
+    Submission.programming_language,
+    Submission.verdict,
+    Submission.testset,
+    Submission.passed_test_count,
+]
+# Replace, submissions of running contests are fetched again
+_SUBMISSION_INSERT = 'INSERT OR REPLACE INTO "{}" ({}) VALUES ({})'.format(
+    Submission._meta.table_name,
+    ', '.join(f'"{field.column_name}"' for field in SUBMISSION_FIELDS),
+    ', '.join('?' for _ in SUBMISSION_FIELDS))
+
+
+def submission_row(s: dict):
+    """The fields of a submission that don't need the db, or None for teams and ghosts:
+    (id, problem index, handle, participant type, language, verdict, testset, passed tests)."""
+    party = s['author']
+    if len(party['members']) != 1:
+        return None
+    # if typ == ParticipantType.PRACTICE or typ == ParticipantType.VIRTUAL:
+    #     continue
+    return (
+        s['id'],
+        s['problem']['index'],
+        party['members'][0]['handle'],
+        ParticipantType[party['participantType']].value,
+        s['programmingLanguage'],
+        Submission.Verdict[s['verdict']].value,
+        s['testset'],
+        s['passedTestCount'],
+    )
+
+
+def parse_submissions(file_path: str, contest_id: int):
+    """Parses a whole contest.status response for the pipeline, yielding the submission_row of
+    every submission and returning (total submissions, max id)."""
+    from .pipeline import open_spooled
+
+    total = max_id = 0
+    with open_spooled(file_path) as fp:
+        for s in api.iter_result(fp):
+            total += 1
+            max_id = max(max_id, s['id'])
+            row = submission_row(s)
+            if row is not None:
+                yield row
+    return total, max_id
+
+
+def resolve_submissions(lookup: Lookup, contest_id: int, rows: Iterable[tuple]):
+    """Turns submission_row tuples into Submission rows in SUBMISSION_FIELDS order, skipping
+    users that aren't rated."""
+    for id_, index, handle, typ, language, verdict, testset, passed in rows:
+        author = lookup.user_ids.get(handle)
+        if author is None:
+            continue  # not rated user
+        yield (
+            id_,
+            contest_id,
+            lookup.contest_problem_ids[contest_id, index],
+            author,
+            typ,
+            lookup.name_id(ProgrammingLanguage, language),
+            verdict,
+            lookup.name_id(Testset, testset),
+            passed,
+        )
+
+
+def insert_submissions(rows: Iterable[tuple]) -> int:
+    """Inserts rows in SUBMISSION_FIELDS order SUBMISSION_CHUNK_SIZE at a time, with a prepared
+    statement rather than insert_many, whose query building takes longer than SQLite does."""
+    conn = models.db.connection()
     rc = 0
-    with models.db.atomic():
-        for piece in chunked(data, 20000):
-            rc += Submission.insert_many(piece, fields=[
-                Submission.id,
-                Submission.contest,
-                Submission.problem,
-                Submission.author,
-                Submission.type,
-                Submission.programming_language,
-                Submission.verdict,
-                Submission.testset,
-                Submission.passed_test_count,
-            ]).execute()
-    print(rc, 'submissions of', len(subs))
-    print('')
-
-# %%
+    for piece in chunked(rows, SUBMISSION_CHUNK_SIZE):
+        conn.executemany(_SUBMISSION_INSERT, piece)
+        rc += len(piece)
+    return rc
+
+
+def download_submissions(
+        lookup: Lookup, phases: Dict[int, str], incremental: bool = False,
+        retry_failed: bool = False, stream: bool = True, pipelined: bool = False):
+    """Downloads submissions of contests not fetched yet.
+
+    In incremental mode, contests that were running when last fetched are fetched again and for
+    the rest only submissions newer than the last seen one are fetched, SUBMISSION_PAGE_SIZE at a
+    time.
+
+    With `stream`, responses are spooled to disk and parsed incrementally, writing
+    SUBMISSION_CHUNK_SIZE rows at a time, so memory use doesn't grow with the contest size.
+
+    With `pipelined`, whole contests are fetched, parsed and written by a pipeline.Pipeline, so
+    that the network, the CPUs and the disk are busy at the same time. Parsed rows wait on disk
+    and are handed over SUBMISSION_CHUNK_SIZE at a time, so memory use still doesn't grow with the
+    contest size. This only pays off with CPUs to spare for the parse workers; on a single one it
+    is no faster than streaming. The pages of incremental fetches are few and small, and are still
+    fetched as above.
+
+    With a ResponseCache, the pages of incremental fetches are kept under page_path, as their own
+    paths are the same in every run. Offline, the pages kept for a contest are replayed after its
+    whole response, so that the cache still rebuilds everything. Fetching a whole contest again
+    drops the pages kept for it.
+    """
+    states = {
+        contest_id: (finished, max_id)
+        for contest_id, finished, max_id in (SyncState
+                                             .select(SyncState.contest,
+                                                     SyncState.contest_finished,
+                                                     SyncState.max_submission_id)
+                                             .where(SyncState.endpoint == 'contest.status')
+                                             .tuples())}
+    todo = []  # (contest, id of the newest submission already stored or None for all)
+    for c in Contest.select():
+        if c.id not in states:
+            todo.append((c, None))
+        elif incremental:
+            finished, max_id = states[c.id]
+            todo.append((c, max_id if finished else None))
+    contests = {c.id for c in skip_failed(started([c for c, _ in todo], phases), 'contest.status',
+                                          retry_failed)}
+    todo = [(c, since) for c, since in todo if c.id in contests]
+    kept = kept_pages() if api.cache is not None else {}
+    replay = []
+    if api.offline and api.cache is not None:
+        # Pages aren't cached under their own paths, the kept ones are replayed at the end
+        replay = [c for c, _ in todo]
+        todo = [(c, since) for c, since in todo if since is None]
+
+    def path_of(c, since, start=1):
+        if since is None:
+            return 'contest.status?contestId=%s' % c.id
+        return 'contest.status?contestId=%s&from=%s&count=%s' % (c.id, start, SUBMISSION_PAGE_SIZE)
+
+    def write(c, since, rows, stats) -> bool:
+        """Writes the rows of a contest, `stats()` giving (total, max id) once they are
+        consumed. Returns whether that worked."""
+        try:
+            with models.db.atomic():
+                rc = insert_submissions(resolve_submissions(lookup, c.id, rows))
+                total, max_id = stats()
+                mark_synced(c, 'contest.status', phases.get(c.id) == 'FINISHED', max_id or None,
+                            changed=total > 0)
+        except Exception as e:
+            # A failed or truncated stream only shows up while parsing
+            queue_failure(c, 'contest.status', path_of(c, since), e)
+            lookup.load_names()
+            return False
+        models.checkpoint()
+        print(rc, 'submissions of', total)
+        print('')
+        return True
+
+    def keep(c, since, starts=()):
+        """Keeps the pages just written in the cache, which had new submissions, or drops those
+        kept before once the whole contest was fetched again."""
+        if api.cache is None or api.offline:
+            return
+        if since is None:
+            for _, _, path in kept.pop(c.id, []):
+                api.cache.remove(path)
+        else:
+            for start in starts:
+                api.cache.move(path_of(c, since, start), page_path(c.id, since, start))
+
+    def replay_pages(c):
+        """Writes the submissions of the pages kept for a contest that are newer than the stored
+        ones, skipping those each run skipped."""
+        state = SyncState.get_or_none(SyncState.contest == c, SyncState.endpoint == 'contest.status')
+        if c.id not in kept or state is None:
+            return
+        print('contest', c.id, c.name, len(kept[c.id]), 'kept pages')
+        total = 0
+        max_id = state.max_submission_id or 0
+
+        def page_subs():
+            nonlocal total, max_id
+            for _, run in itertools.groupby(kept[c.id], key=lambda page: page[0]):
+                newest = max_id
+                for _, _, path in run:
+                    with api.api_get_stream(path) as fp:
+                        for s in api.iter_result(fp):
+                            if s['id'] <= newest:
+                                break
+                            total += 1
+                            max_id = max(max_id, s['id'])
+                            yield s
+
+        rows = (row for row in map(submission_row, page_subs()) if row is not None)
+        write(c, state.max_submission_id, rows, lambda: (total, max_id))
+
+    if pipelined:
+        from .pipeline import Pipeline
+
+        whole = [(c, since) for c, since in todo if since is None]
+        todo = [(c, since) for c, since in todo if since is not None]
+        pipeline = Pipeline(parse_submissions, chunk_size=SUBMISSION_CHUNK_SIZE)
+        for (c, since), result, err in pipeline.run(whole, lambda item: path_of(*item),
+                                                    arg_of=lambda item: item[0].id):
+            print('contest', c.id, c.name)
+            if err is not None:
+                queue_failure(c, 'contest.status', path_of(c, since), err)
+                continue
+            rows, stats = result
+            if write(c, since, rows, lambda: stats):
+                keep(c, since)
+
+    fetch = api.api_get_stream if stream else api_get
+    for (c, since), resp, err in fetch_all(todo, lambda item: path_of(*item), fetch=fetch):
+        print('contest', c.id, c.name)
+        if err is not None:
+            queue_failure(c, 'contest.status', path_of(c, since), err)
+            continue
+        print('got resp')
+
+        total = 0
+        max_id = since or 0
+        starts = [1]
+        def new_subs(resp):
+            # Submissions come newest first, so stop at the first one already stored
+            nonlocal total, max_id
+            start = 1
+            while True:
+                count = 0
+                try:
+                    for s in (api.iter_result(resp) if stream else resp):
+                        count += 1
+                        if since is not None and s['id'] <= since:
+                            return
+                        total += 1
+                        max_id = max(max_id, s['id'])
+                        yield s
+                finally:
+                    if stream:
+                        resp.close()
+                if since is None or count < SUBMISSION_PAGE_SIZE:
+                    return
+                start += SUBMISSION_PAGE_SIZE
+                starts.append(start)
+                resp = fetch(path_of(c, since, start))
+
+        rows = (row for row in map(submission_row, new_subs(resp)) if row is not None)
+        if write(c, since, rows, lambda: (total, max_id)) and total:
+            keep(c, since, starts)
+
+    for c in replay:
+        replay_pages(c)
+
+
+def page_path(contest_id: int, since: int, start: int) -> str:
+    """Where a page of the submissions of a contest newer than `since` is kept in the cache."""
+    return 'contest.status?contestId=%s&since=%s&from=%s&count=%s' % (
+        contest_id, since, start, SUBMISSION_PAGE_SIZE)
+
+
+def kept_pages() -> Dict[int, List[Tuple[int, int, str]]]:
+    """Contest id to the (since, start, path) of the pages kept in the cache, in the order they
+    were fetched."""
+    kept = {}
+    for path in api.cache.calls('contest.status'):
+        params = {key: int(values[0]) for key, values in parse_qs(path.partition('?')[2]).items()}
+        if 'since' in params:
+            kept.setdefault(params['contestId'], []).append(
+                (params['since'], params['from'], path))
+    return {contest_id: sorted(pages) for contest_id, pages in kept.items()}
+
+
+CONTEST_STAGES = {
+    'standings': download_standings,
+    'hacks': download_hacks,
+    'rating-changes': download_rating_changes,
+    'submissions': download_submissions,
+}
+STAGES = ['users', 'contests'] + list(CONTEST_STAGES)
+STAGE_ENDPOINTS = {
+    'standings': 'contest.standings',
+    'hacks': 'contest.hacks',
+    'rating-changes': 'contest.ratingChanges',
+    'submissions': 'contest.status',
+}
+
+
+def main(db_path: str = 'cf.db', incremental: bool = False, cache_dir: str = None,
+         offline: bool = False, bulk: bool = False, stages: List[str] = None,
+         retry_failed: bool = False, shards: int = 1,
+         pipelined: bool = False) -> Dict[str, float]:
+    """Runs the download stages in STAGES, or only those in `stages`, returning how long each
+    took. The contest list is fetched for the per-contest stages even if 'contests' isn't one of
+    them. A database in the old layout storing strings inline is refused until it is migrated,
+    see migrate.
+
+    With `cache_dir`, raw responses are kept in a ResponseCache there. With `offline` too, the db
+    is built from the cache alone, e.g. main('new.db', cache_dir='cache', offline=True) rebuilds
+    everything after a schema change without touching the network.
+
+    With `bulk`, contest data is written in models.bulk_load mode, meant for the first download
+    or a rebuild.
+
+    Contest data that fails to download is queued in FailedRequest and tried again by the next
+    runs, up to MAX_FAILED_RUNS times. With `retry_failed`, the contest stages only retry the
+    queued contests, however often they failed.
+
+    With more than one of `shards`, the contest stages run in that many processes writing to
+    shard databases that are merged in afterwards, see shard.
+
+    With `pipelined`, submissions are downloaded with fetching, parsing and writing overlapped,
+    see download_submissions.
+    """
+    stages = STAGES if stages is None else stages
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f'unknown stages {sorted(unknown)}, expected some of {STAGES}')
+    contest_stages = [stage for stage in CONTEST_STAGES if stage in stages]
+
+    if cache_dir is not None:
+        api.cache = ResponseCache(cache_dir)
+    api.offline = offline
+
+    models.init(db_path)
+    models.connect()
+    # Before create_tables, whose indexes refer to the new columns
+    if migrate.needs_migration():
+        raise RuntimeError(f'{db_path} has the old layout storing strings inline, migrate it '
+                           f'first with: python -m cfa.migrate {db_path} --vacuum')
+    models.create_tables()
+    if not SyncState.select().exists():
+        backfill_sync_state()
+
+    timings = {}
+    def timed(name, func, *args):
+        start = time.monotonic()
+        result = func(*args)
+        timings[name] = time.monotonic() - start
+        return result
+
+    lookup = timed('lookup', Lookup)
+    if 'users' in stages:
+        timed('users', download_users, lookup)
+    if 'contests' in stages or contest_stages:
+        phases = timed('contests', download_contests)
+    if contest_stages and shards > 1:
+        timed('shards', shard.download_sharded, db_path, shards, contest_stages, phases,
+              incremental, retry_failed, bulk, cache_dir, offline)
+    else:
+        with (models.bulk_load() if bulk else contextlib.nullcontext()):
+            for stage in contest_stages:
+                func = CONTEST_STAGES[stage]
+                if stage == 'submissions' and pipelined:
+                    func = functools.partial(download_submissions, pipelined=True)
+                timed(stage, func, lookup, phases, incremental, retry_failed)
+    # Bulk loads and shards don't update the aggregates as they go
+    if contest_stages and (bulk or shards > 1 or not UserStats.select().exists()):
+        timed('aggregates', aggregates.rebuild)
+    print(api.stats.report())
+    print('  limiter:', api.limiter.report())
+    queued = FailedRequest.select().count()
+    if queued:
+        print(queued, 'failed requests queued')
+    print(' '.join(f'{name} {elapsed:.2f}s' for name, elapsed in timings.items()))
+    return timings
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,285 @@
+import datetime as dt
+import multiprocessing
 import time
-from typing import List
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+
+from peewee import chunked
 
 from . import models
-from .models import User, RanklistRow
+from .models import User, RanklistRow, Submission, RatingChange, Hack
+from .models import ChangedUser, ChangedContest, StoredGrant, GeneratedAchievement, DataVersion
 
-from .achievement import Achievement, AchievementWithStats, registered_achievements
+from .achievement import Achievement, AchievementWithStats, Grant, registered_achievements
+from .grant_cache import GrantCache, TableRecorder, cache_path
 
 from . import achievements
 
-def get_achievements() -> List[AchievementWithStats]:
+def get_achievements(db_path: str = 'cf.db', workers: int = 1, use_cache: bool = True,
+                     only: List[str] = None) -> List[AchievementWithStats]:
+    """Calculates the grants of every registered achievement, after loading those of the
+    achievement modules in `only`, or of all modules.
+
+    With more than one worker, achievements are evaluated in parallel by a process pool, each
+    worker with its own read-only connection. Results are in registration order either way.
+
+    With `use_cache`, achievements whose code and data haven't changed since they were last
+    calculated get their grants from the GrantCache instead.
+
+    The time each achievement took is in its `elapsed`, families being timed as a whole.
+    """
     if models.db.is_closed():
-        models.init('cf.db')
+        models.init(db_path)
         models.connect()
 
+    achievements.load(only)
     achs = registered_achievements()
 
     total_users = User.select().count()
 
-    achievements_with_stats = []
-    for ach in achs:
-        start = time.monotonic()
-        grants = ach.calculate_grants()
-        elapsed = time.monotonic() - start
+    units = _group_units(achs)
+    # Read before evaluating, so that writes during it make the cached grants stale
+    models.db.create_tables([DataVersion])
+    versions = models.data_versions()
+    cache = GrantCache(cache_path(db_path)) if use_cache else None
+    cached = {}
+    if cache is not None:
+        for n, unit in enumerate(units):
+            grants = cache.get([achs[i] for i in unit], versions)
+            if grants is not None:
+                cached[n] = grants
+    todo = [unit for n, unit in enumerate(units) if n not in cached]
 
+    snapshot_path = _prepare_snapshot(db_path, [achs[i] for unit in todo for i in unit])
+    start = time.monotonic()
+    if workers > 1:
+        results = _evaluate_parallel(db_path, todo, workers, snapshot_path, only)
+    else:
+        results = (_evaluate_recording([achs[i] for i in unit]) for unit in todo)
+
+    grants_by_index, elapsed_by_index = {}, {}
+    for n, unit in enumerate(units):
+        if n in cached:
+            unit_grants, elapsed = cached[n], None
+        else:
+            unit_grants, elapsed, tables = next(results)
+            if cache is not None:
+                cache.put([achs[i] for i in unit], unit_grants, tables, versions)
+        for i, grants in zip(unit, unit_grants):
+            grants_by_index[i] = grants
+            elapsed_by_index[i] = elapsed if i == unit[0] or elapsed is None else 0.0
+    if cache is not None:
+        cache.close()
+
+    achievements_with_stats = []
+    for i, ach in enumerate(achs):
+        grants = grants_by_index[i]
         users_awarded = len(set(grant.handle for grant in grants))
         users_awarded_fraction = users_awarded / total_users
+        elapsed = elapsed_by_index[i]
         achievements_with_stats.append(
-            AchievementWithStats(ach, grants, users_awarded, users_awarded_fraction))
-        print(ach, f'{elapsed:.2f}s', len(grants), 'grants')
+            AchievementWithStats(ach, grants, users_awarded, users_awarded_fraction, elapsed))
+        print(ach, _timing(ach, elapsed), len(grants), 'grants')
+    print(f'total {time.monotonic() - start:.2f}s')
 
     return achievements_with_stats
+
+
+def _timing(ach: Achievement, elapsed: Optional[float]) -> str:
+    if elapsed is None:
+        return 'cached'
+    if ach.family is None:
+        return f'{elapsed:.2f}s'
+    if ach is ach.family.members[0]:
+        return f'{elapsed:.2f}s for the family of {len(ach.family.members)}'
+    return '(family)'
+
+
+def _group_units(achs: List[Achievement]) -> List[List[int]]:
+    """Groups achievement indices into units that are evaluated together: all members of a
+    family, or a single achievement."""
+    units, family_units = [], {}
+    for i, ach in enumerate(achs):
+        if ach.family is None:
+            units.append([i])
+        elif id(ach.family) in family_units:
+            family_units[id(ach.family)].append(i)
+        else:
+            family_units[id(ach.family)] = [i]
+            units.append(family_units[id(ach.family)])
+    return units
+
+
+def _prepare_snapshot(db_path: str, achs: List[Achievement]) -> Optional[str]:
+    """Prepares the snapshot if any of the achievements use it, returning its path."""
+    if not any(ach.snapshot for ach in achs):
+        return None
+    # numpy is only needed by snapshot achievements
+    from . import snapshot
+    return snapshot.prepare(db_path).path
+
+
+def _evaluate(unit: List[Achievement], **kwargs) -> Tuple[List[List[Grant]], float]:
+    start = time.monotonic()
+    if unit[0].snapshot:
+        from . import snapshot
+        kwargs['snapshot'] = snapshot.current()
+    family = unit[0].family
+    if family is None:
+        grants = [unit[0].calculate_grants(**kwargs)]
+    else:
+        by_key = family.calculate_grants(**kwargs)
+        grants = [by_key.get(ach.family_key, []) for ach in unit]
+    return grants, time.monotonic() - start
+
+
+def _evaluate_recording(unit: List[Achievement]) -> Tuple[List[List[Grant]], float, List[str]]:
+    """Like _evaluate, also returning the tables read for the GrantCache."""
+    with TableRecorder() as recorder:
+        grants, elapsed = _evaluate(unit)
+    tables = recorder.tables
+    if unit[0].snapshot:
+        from . import snapshot
+        tables |= {model._meta.table_name for model in snapshot.SNAPSHOT_MODELS}
+    return grants, elapsed, sorted(tables)
+
+
+def _evaluate_parallel(db_path: str, units: List[List[int]], workers: int,
+                       snapshot_path: Optional[str], only: Optional[List[str]]):
+    # Spawn rather than fork so that workers don't inherit the parent's sqlite connection
+    context = multiprocessing.get_context('spawn')
+    titles = [[registered_achievements()[i].title for i in unit] for unit in units]
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                             initargs=(db_path, snapshot_path, only)) as executor:
+        yield from executor.map(_evaluate_in_worker, titles)
+
+
+def _init_worker(db_path: str, snapshot_path: Optional[str], only: Optional[List[str]]):
+    models.init(db_path, read_only=True)
+    models.connect()
+    achievements.load(only)
+    if snapshot_path is not None:
+        from . import snapshot
+        snapshot.use(snapshot_path)
+
+
+def _evaluate_in_worker(titles: List[str]) -> Tuple[List[List[Grant]], float, List[str]]:
+    # By title, as the parent may have registered the same achievements in another order, e.g. by
+    # loading modules over several calls
+    by_title = {ach.title: ach for ach in registered_achievements()}
+    return _evaluate_recording([by_title[title] for title in titles])
+
+
+class GrantDiff(NamedTuple):
+    achievement: Achievement
+    added: List[Grant]
+    revoked: List[Grant]
+
+
+def get_achievements_incremental(
+        db_path: str = 'cf.db',
+        only: List[str] = None) -> Tuple[List[AchievementWithStats], List[GrantDiff]]:
+    """Like get_achievements, but only recalculates what changed since the last call.
+
+    Incremental achievements that were generated before are recalculated only for users whose
+    data changed since, as recorded by download in ChangedUser and ChangedContest; the rest are
+    recalculated fully. Grants are kept in StoredGrant, and the added and revoked grants of each
+    achievement are returned along with the current ones. Achievement titles must be unique.
+    `only` is as for get_achievements. Changes are only cleared once every module was evaluated,
+    so that the achievements of the other modules still see them; the next run recalculates the
+    ones evaluated now for the same users again, which finds no difference.
+    """
+    if models.db.is_closed():
+        models.init(db_path)
+        models.connect()
+
+    models.db.create_tables([ChangedUser, ChangedContest, StoredGrant, GeneratedAchievement])
+    achievements.load(only)
+    achs = registered_achievements()
+    total_users = User.select().count()
+    generated = {title for title, in GeneratedAchievement.select(GeneratedAchievement.title).tuples()}
+
+    units = _group_units(achs)
+    _prepare_snapshot(db_path, achs)
+    incremental = [all(achs[i].incremental and achs[i].title in generated for i in unit)
+                   for unit in units]
+    if any(incremental):
+        _add_contest_users_to_changed()
+    changed_ids = ChangedUser.select(ChangedUser.user)
+    changed_handles = User.select(User.handle).where(User.id.in_(changed_ids))
+
+    start = time.monotonic()
+    diffs = []
+    elapsed_by_title = {}
+    with models.db.atomic():
+        for unit, unit_incremental in zip(units, incremental):
+            unit_achs = [achs[i] for i in unit]
+            kwargs = dict(user_ids=changed_ids) if unit_incremental else {}
+            unit_grants, elapsed = _evaluate(unit_achs, **kwargs)
+            for ach, grants in zip(unit_achs, unit_grants):
+                elapsed_by_title[ach.title] = elapsed if ach is unit_achs[0] else 0.0
+                old = StoredGrant.delete().where(StoredGrant.achievement == ach.title)
+                old_query = (StoredGrant
+                             .select(StoredGrant.handle, StoredGrant.info)
+                             .where(StoredGrant.achievement == ach.title))
+                if unit_incremental:
+                    old = old.where(StoredGrant.handle.in_(changed_handles))
+                    old_query = old_query.where(StoredGrant.handle.in_(changed_handles))
+                old_grants = Counter(Grant(*g) for g in old_query.tuples())
+                new_grants = Counter(grants)
+                diff = GrantDiff(ach, list((new_grants - old_grants).elements()),
+                                 list((old_grants - new_grants).elements()))
+                diffs.append(diff)
+
+                old.execute()
+                data = [(ach.title, g.handle, g.info) for g in grants]
+                for piece in chunked(data, 10000):
+                    StoredGrant.insert_many(piece, fields=[
+                        StoredGrant.achievement, StoredGrant.handle, StoredGrant.info,
+                    ]).execute()
+                (GeneratedAchievement
+                 .insert(title=ach.title, generated_at=dt.datetime.utcnow())
+                 .on_conflict_replace()
+                 .execute())
+                mode = 'incremental' if unit_incremental else 'full'
+                print(ach, _timing(ach, elapsed_by_title[ach.title]), mode,
+                      f'+{len(diff.added)} -{len(diff.revoked)}')
+
+        if only is None or set(only) >= set(achievements.MODULES):
+            ChangedUser.delete().execute()
+            ChangedContest.delete().execute()
+    print(f'total {time.monotonic() - start:.2f}s')
+
+    achievements_with_stats = []
+    for ach in achs:
+        query = (StoredGrant
+                 .select(StoredGrant.handle, StoredGrant.info)
+                 .where(StoredGrant.achievement == ach.title)
+                 .order_by(StoredGrant.id)
+                 .tuples())
+        grants = [Grant(*g) for g in query]
+        users_awarded = len(set(grant.handle for grant in grants))
+        achievements_with_stats.append(
+            AchievementWithStats(ach, grants, users_awarded, users_awarded / total_users,
+                                 elapsed_by_title[ach.title]))
+
+    return achievements_with_stats, diffs
+
+
+def _add_contest_users_to_changed():
+    """Adds the users taking part in changed contests to ChangedUser."""
+    contests = ChangedContest.select(ChangedContest.contest)
+    queries = [
+        RanklistRow.select(RanklistRow.user).where(RanklistRow.contest.in_(contests)),
+        Submission.select(Submission.author).where(Submission.contest.in_(contests)),
+        RatingChange.select(RatingChange.user).where(RatingChange.contest.in_(contests)),
+        Hack.select(Hack.hacker).where(Hack.contest.in_(contests)),
+        Hack.select(Hack.defender).where(Hack.contest.in_(contests)),
+    ]
+    with models.db.atomic():
+        for query in queries:
+            (ChangedUser
+             .insert_from(query.distinct(), [ChangedUser.user])
+             .on_conflict_ignore()
+             .execute())
@@ -0,0 +1,197 @@
+"""Persistent cache of achievement grants, so that unchanged achievements aren't recalculated.
+
+Entries are keyed by the achievement titles of a unit (one achievement, or a whole family) and a
+hash of the source of its function, including the functions, classes and constants of its module
+that it refers to by name. Each entry records the tables the calculation read, taken from its
+queries, and their versions in DataVersion at the time, which download replaces whenever it
+writes to a table. An entry is used only if those versions are all still current.
+
+The cache lives in its own SQLite file next to the database, <db>.grants, and is kept under
+`max_bytes` by evicting the least recently used entries.
+
+    python -m cfa.grant_cache cf.db --invalidate Newbie Pupil
+    python -m cfa.grant_cache cf.db --clear
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import re
+import sqlite3
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional, Set
+
+from . import models
+from .achievement import Achievement, Grant
+
+DEFAULT_MAX_BYTES = 1 << 30
+# Fraction of max_bytes to evict down to, so that eviction doesn't run on every put
+EVICT_TO = 0.9
+# Bump when the entry layout changes
+FORMAT_VERSION = 1
+_TABLE_RE = re.compile(r'(?:FROM|JOIN)\s+"(\w+)"')
+
+
+def cache_path(db_path: str) -> str:
+    return db_path + '.grants'
+
+
+def _names(code) -> Iterable[str]:
+    yield from code.co_names
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            yield from _names(const)
+
+
+def code_hash(func) -> str:
+    """Hash of the source of a function and of what it refers to in its own module."""
+    h = hashlib.sha256(str(FORMAT_VERSION).encode())
+    module = inspect.getmodule(func)
+    seen = set()
+
+    def add(obj):
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            h.update(getattr(getattr(obj, '__code__', None), 'co_code', b''))
+        code = getattr(obj, '__code__', None)
+        if code is None:
+            return
+        for name in _names(code):
+            value = getattr(module, name, None)
+            if inspect.isfunction(value) or inspect.isclass(value):
+                if inspect.getmodule(value) is module:
+                    add(value)
+            elif isinstance(value, (int, float, str, tuple, list, dict, frozenset, set)):
+                h.update(f'{name}={value!r}'.encode())
+
+    add(func)
+    return h.hexdigest()
+
+
+def _unit_func(unit: List[Achievement]):
+    family = unit[0].family
+    return unit[0].calculate_grants if family is None else family.calculate_grants
+
+
+def _unit_key(unit: List[Achievement]) -> str:
+    return '\n'.join(ach.title for ach in unit)
+
+
+class TableRecorder:
+    """Context manager collecting the tables named in the queries run on models.db while active."""
+
+    def __init__(self):
+        self.tables: Set[str] = set()
+
+    def __enter__(self):
+        execute_sql = models.db.execute_sql
+
+        def hooked(sql, *args, **kwargs):
+            self.tables.update(_TABLE_RE.findall(sql))
+            return execute_sql(sql, *args, **kwargs)
+
+        self._previous = models.db.__dict__.get('execute_sql')
+        models.db.execute_sql = hooked
+        return self
+
+    def __exit__(self, *exc):
+        if self._previous is None:
+            del models.db.execute_sql
+        else:
+            models.db.execute_sql = self._previous
+
+
+class GrantCache:
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS entry (unit TEXT, code_hash TEXT, tables TEXT, '
+            'versions TEXT, grants BLOB, size INTEGER, used_at REAL, '
+            'PRIMARY KEY (unit, code_hash))')
+
+    def get(self, unit: List[Achievement],
+            versions: Dict[str, str]) -> Optional[List[List[Grant]]]:
+        """Grants of each achievement of the unit, if cached with the current data versions."""
+        key = (_unit_key(unit), code_hash(_unit_func(unit)))
+        row = self.conn.execute(
+            'SELECT tables, versions, grants FROM entry WHERE unit = ? AND code_hash = ?',
+            key).fetchone()
+        if row is None:
+            return None
+        tables, stored_versions, blob = row
+        if json.loads(stored_versions) != [versions.get(t) for t in json.loads(tables)]:
+            return None
+        with self.conn:
+            self.conn.execute('UPDATE entry SET used_at = ? WHERE unit = ? AND code_hash = ?',
+                              (time.time(),) + key)
+        return [[Grant(*g) for g in grants] for grants in json.loads(zlib.decompress(blob))]
+
+    def put(self, unit: List[Achievement], grants: List[List[Grant]], tables: List[str],
+            versions: Dict[str, str]):
+        """Stores the grants of a unit, calculated from the given tables at the given versions.
+        The versions must have been read before the calculation started."""
+        blob = zlib.compress(json.dumps(grants, separators=(',', ':')).encode())
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (_unit_key(unit), code_hash(_unit_func(unit)), json.dumps(tables),
+                 json.dumps([versions.get(t) for t in tables]), blob, len(blob), time.time()))
+            self._evict()
+
+    def _evict(self):
+        total, = self.conn.execute('SELECT IFNULL(SUM(size), 0) FROM entry').fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute('SELECT rowid, size FROM entry ORDER BY used_at').fetchall()
+        for rowid, size in rows:
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            self.conn.execute('DELETE FROM entry WHERE rowid = ?', (rowid,))
+            total -= size
+
+    def invalidate(self, titles: Iterable[str] = None) -> int:
+        """Drops the entries of units containing any of the given achievements, or all entries.
+        Returns how many were dropped."""
+        with self.conn:
+            if titles is None:
+                return self.conn.execute('DELETE FROM entry').rowcount
+            titles = set(titles)
+            units = [unit for unit, in self.conn.execute('SELECT DISTINCT unit FROM entry')
+                     if titles & set(unit.split('\n'))]
+            return sum(self.conn.execute('DELETE FROM entry WHERE unit = ?', (unit,)).rowcount
+                       for unit in units)
+
+    def stats(self) -> str:
+        count, total = self.conn.execute(
+            'SELECT COUNT(*), IFNULL(SUM(size), 0) FROM entry').fetchone()
+        return f'{count} entries, {total / 2**20:.1f} MiB of {self.max_bytes / 2**20:.0f} MiB'
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or invalidate the grant cache')
+    parser.add_argument('db', nargs='?', default='cf.db')
+    parser.add_argument('--invalidate', nargs='+', metavar='TITLE',
+                        help='drop the entries of these achievements')
+    parser.add_argument('--clear', action='store_true', help='drop all entries')
+    args = parser.parse_args()
+    cache = GrantCache(cache_path(args.db))
+    if args.clear:
+        print(cache.invalidate(), 'entries dropped')
+    elif args.invalidate:
+        print(cache.invalidate(args.invalidate), 'entries dropped')
+    print(cache.stats())
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Suggests indexes for the queries of the registered achievements.
+
+    python -m cfa.index_advisor --db cf.db [--create]
+
+Each achievement is run with its queries logged and their plans looked up with EXPLAIN QUERY
+PLAN. Full scans not using a covering index and temp B-trees for GROUP BY, ORDER BY or DISTINCT
+are flagged, and for each flagged table an index is proposed: the columns compared for equality
+first, then one compared by range, then those grouped or ordered by, then the rest of the columns
+the query reads so that the index covers it. Each candidate is created, measured (size, whether
+the plan now uses it, achievement time before and after) and dropped again unless --create is
+given, in which case indexes that were used and made their achievements faster are kept. Add
+the kept ones to the model's Meta.indexes so that create_tables knows about them.
+
+The column extraction is a heuristic over the SQL peewee generates, quoted "alias"."column"
+references, and is no substitute for reading the plan in the report.
+"""
+import argparse
+import json
+import re
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from . import achievements, models
+from .achievement import Achievement, registered_achievements
+from .generate import _evaluate, _group_units, _prepare_snapshot
+from .profiling import QueryLog, QueryStats, explain
+
+# Most columns put in one candidate index; covering columns are dropped first to stay under it
+MAX_INDEX_COLUMNS = 6
+TIMING_REPEATS = 3
+
+_TABLE_RE = re.compile(r'(?:FROM|JOIN)\s+"(\w+)"(?:\s+AS\s+"(\w+)")?')
+_COLUMN_RE = re.compile(r'"(\w+)"\."(\w+)"')
+_EQUALITY_RE = re.compile(r'"(\w+)"\."(\w+)"\s*(?:=|\bIN\b|\bIS\b)')
+_EQUALITY_RHS_RE = re.compile(r'=\s*"(\w+)"\."(\w+)"')
+_RANGE_RE = re.compile(r'"(\w+)"\."(\w+)"\s*(?:<|>|\bBETWEEN\b)')
+_CLAUSE_RE = re.compile(r'\b(?:GROUP|ORDER) BY\b(.*?)(?=\bHAVING\b|\bORDER BY\b|\bLIMIT\b|\)|$)')
+_SCAN_RE = re.compile(r'^\s*SCAN (\w+)\b(?! USING COVERING INDEX)')
+_TEMP_RE = re.compile(r'USE TEMP B-TREE FOR (.*)')
+
+
+class PlanIssue(NamedTuple):
+    sql: str
+    params: tuple
+    plan_line: str
+    alias: str  # empty for temp B-trees, which aren't tied to a table in the plan
+
+
+class Candidate(NamedTuple):
+    table: str
+    columns: Tuple[str, ...]
+
+    @property
+    def name(self) -> str:
+        return 'advised_' + '_'.join((self.table,) + self.columns)[:120]
+
+    def create_sql(self) -> str:
+        columns = ', '.join(f'"{c}"' for c in self.columns)
+        return f'CREATE INDEX IF NOT EXISTS "{self.name}" ON "{self.table}" ({columns})'
+
+
+def find_issues(stats: QueryStats) -> List[PlanIssue]:
+    issues = []
+    params = tuple(stats.params or ())
+    for line in stats.plan:
+        scan = _SCAN_RE.match(line)
+        if scan is not None:
+            issues.append(PlanIssue(stats.sql, params, line.strip(), scan.group(1)))
+        elif _TEMP_RE.search(line):
+            issues.append(PlanIssue(stats.sql, params, line.strip(), ''))
+    return issues
+
+
+def propose(sql: str, alias: str) -> Optional[Candidate]:
+    """Proposes an index for one table of a query, `alias` being its alias or table name, or
+    None if the query reads no columns of it but the primary key."""
+    tables = {}
+    for table, table_alias in _TABLE_RE.findall(sql):
+        tables[table_alias or table] = table
+    table = tables.get(alias, alias)
+
+    def columns_of(pairs):
+        return [column for a, column in pairs if a == alias]
+
+    equality = columns_of(_EQUALITY_RE.findall(sql)) + columns_of(_EQUALITY_RHS_RE.findall(sql))
+    range_ = columns_of(_RANGE_RE.findall(sql))[:1]
+    ordered = [column for clause in _CLAUSE_RE.findall(sql)
+               for column in columns_of(_COLUMN_RE.findall(clause))]
+    # Every index has the rowid, which the integer primary keys here are aliases of
+    covering = [column for column in columns_of(_COLUMN_RE.findall(sql)) if column != 'id']
+
+    key = list(dict.fromkeys(equality + range_ + ordered))[:MAX_INDEX_COLUMNS]
+    columns = list(dict.fromkeys(key + covering))
+    if len(columns) > MAX_INDEX_COLUMNS:
+        columns = key
+    if not columns:
+        return None
+    # With no key columns, a covering index only helps by being narrower than the table
+    return Candidate(table, tuple(columns))
+
+
+def _candidates_for(issues: List[PlanIssue]) -> List[Candidate]:
+    candidates = []
+    for issue in issues:
+        aliases = [issue.alias]
+        if not issue.alias:
+            # Attribute a temp B-tree to the table of the first query column grouped or ordered by
+            aliases = [a for clause in _CLAUSE_RE.findall(issue.sql)
+                       for a, _ in _COLUMN_RE.findall(clause)][:1]
+        for alias in aliases:
+            candidate = propose(issue.sql, alias)
+            if candidate is not None and candidate not in candidates:
+                candidates.append(candidate)
+    return candidates
+
+
+def _existing_prefixes(table: str) -> List[Tuple[str, ...]]:
+    return [tuple(index.columns) for index in models.db.get_indexes(table)]
+
+
+def _index_size(name: str) -> int:
+    try:
+        cursor = models.db.execute_sql('SELECT SUM(pgsize) FROM dbstat WHERE name = ?', (name,))
+        return cursor.fetchone()[0] or 0
+    except Exception:
+        # SQLite built without dbstat
+        return -1
+
+
+def _time_unit(unit: List[Achievement], repeats: int = TIMING_REPEATS) -> float:
+    return min(_evaluate(unit)[1] for _ in range(repeats))
+
+
+def _field_names(table: str, columns: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Maps column names to model field names for a Meta.indexes entry."""
+    def subclasses(cls):
+        for sub in cls.__subclasses__():
+            yield sub
+            yield from subclasses(sub)
+    for model in subclasses(models.BaseModel):
+        if model._meta.table_name == table:
+            return tuple(model._meta.columns[c].name if c in model._meta.columns else c
+                         for c in columns)
+    return columns
+
+
+def advise(db_path: str = 'cf.db', create: bool = False, report_path: str = None) -> dict:
+    """Runs the advisor, printing the findings and returning them as a report, also written as
+    JSON to `report_path` if given. Candidates are created on the database and dropped
+    afterwards unless `create`, so it must be writable."""
+    if models.db.is_closed():
+        models.init(db_path)
+        models.connect()
+
+    achievements.load()
+    achs = registered_achievements()
+    _prepare_snapshot(db_path, achs)
+    units = [[achs[i] for i in unit] for unit in _group_units(achs)]
+
+    flagged: List[Tuple[List[Achievement], List[PlanIssue], float]] = []
+    for unit in units:
+        with QueryLog() as log:
+            _evaluate(unit)
+        issues = [issue for stats in log.queries.values() for issue in find_issues(stats)]
+        if issues:
+            flagged.append((unit, issues, _time_unit(unit)))
+
+    candidate_units: Dict[Candidate, List[int]] = {}
+    for n, (_, issues, _) in enumerate(flagged):
+        for candidate in _candidates_for(issues):
+            candidate_units.setdefault(candidate, []).append(n)
+
+    conn = models.db.connection()
+    results = []
+    for candidate, unit_numbers in candidate_units.items():
+        if any(prefix[:len(candidate.columns)] == candidate.columns
+               for prefix in _existing_prefixes(candidate.table)):
+            continue
+        start = time.monotonic()
+        models.db.execute_sql(candidate.create_sql())
+        build_time = time.monotonic() - start
+        size = _index_size(candidate.name)
+
+        used, timings = False, []
+        for n in unit_numbers:
+            unit, issues, before = flagged[n]
+            for issue in issues:
+                plan = explain(conn, issue.sql, issue.params)
+                used |= any(candidate.name in line for line in plan)
+            timings.append({
+                'achievements': [ach.title for ach in unit],
+                'before': round(before, 6),
+                'after': round(_time_unit(unit), 6),
+            })
+        keep = create and used and all(t['after'] < t['before'] for t in timings)
+        if not keep:
+            models.db.execute_sql(f'DROP INDEX "{candidate.name}"')
+
+        result = {
+            'table': candidate.table,
+            'columns': list(candidate.columns),
+            'sql': candidate.create_sql(),
+            'meta_index': [list(_field_names(candidate.table, candidate.columns)), False],
+            'size': size,
+            'build_time': round(build_time, 6),
+            'used': used,
+            'kept': keep,
+            'timings': timings,
+        }
+        results.append(result)
+        print(candidate.create_sql())
+        print(f'  {size / 2**20:.1f} MiB, built in {build_time:.2f}s, '
+              f'{"used" if used else "not used"}{", kept" if keep else ""}')
+        for t in timings:
+            print(f"  {t['achievements'][0]:<40} {t['before']:8.3f}s -> {t['after']:8.3f}s")
+
+    report = {
+        'db': db_path,
+        'flagged': [{
+            'achievements': [ach.title for ach in unit],
+            'time': round(elapsed, 6),
+            'issues': [{'sql': i.sql, 'plan': i.plan_line} for i in issues],
+        } for unit, issues, elapsed in flagged],
+        'candidates': results,
+    }
+    if not flagged:
+        print('no full scans or temp B-trees')
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Suggest indexes for achievement queries')
+    parser.add_argument('--db', default='cf.db')
+    parser.add_argument('--report', default='indexes.json', help='JSON report path')
+    parser.add_argument('--create', action='store_true',
+                        help='keep the indexes that are used and make achievements faster')
+    args = parser.parse_args()
+    advise(args.db, args.create, args.report)
+
+
+if __name__ == '__main__':
+    main()
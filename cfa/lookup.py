@@ -0,0 +1,63 @@
+import datetime as dt
+from typing import Dict, Tuple, Type
+
+from .models import User, Problem, ContestProblem, NameModel, ProgrammingLanguage, Testset, Tag
+
+
+class Lookup:
+    """In-memory id maps shared by the download stages so that ingest doesn't query per row.
+
+    The maps only grow; call the load_* methods after inserting to pick up the new ids.
+    """
+
+    def __init__(self):
+        self.user_ids: Dict[str, int] = {}
+        self.problem_ids: Dict[Tuple[str, dt.datetime], int] = {}
+        self.contest_problem_ids: Dict[Tuple[int, str], int] = {}
+        self.name_ids: Dict[Type[NameModel], Dict[str, int]] = {}
+        self._max_user_id = 0
+        self.load_names()
+        self.load_users()
+        self.load_problems()
+        self.load_contest_problems()
+
+    def load_names(self):
+        """Loads the name tables afresh, e.g. after a rollback undid names added by name_id."""
+        for model in [ProgrammingLanguage, Testset, Tag]:
+            self.name_ids[model] = dict(model.select(model.name, model.id).tuples())
+
+    def name_id(self, model: Type[NameModel], name: str) -> int:
+        """Id of a name in one of the name tables, adding it if new."""
+        ids = self.name_ids[model]
+        id_ = ids.get(name)
+        if id_ is None:
+            model.insert(name=name).on_conflict_ignore().execute()
+            id_ = ids[name] = model.get(model.name == name).id
+        return id_
+
+    def load_users(self):
+        """Loads users added since the last call."""
+        query = (User
+                 .select(User.id, User.handle)
+                 .where(User.id > self._max_user_id)
+                 .tuples())
+        for id_, handle in query:
+            self.user_ids[handle] = id_
+            self._max_user_id = max(self._max_user_id, id_)
+
+    def load_problems(self, contest_start_time: dt.datetime = None):
+        """Loads all problems, or only those of contests starting at the given time."""
+        query = Problem.select(Problem.id, Problem.name, Problem.contest_start_time)
+        if contest_start_time is not None:
+            query = query.where(Problem.contest_start_time == contest_start_time)
+        for id_, name, start_time in query.tuples():
+            self.problem_ids[name, start_time] = id_
+
+    def load_contest_problems(self, contest_id: int = None):
+        """Loads all contest problems, or only those of the given contest."""
+        query = ContestProblem.select(
+            ContestProblem.id, ContestProblem.contest, ContestProblem.index)
+        if contest_id is not None:
+            query = query.where(ContestProblem.contest == contest_id)
+        for id_, contest_id_, index in query.tuples():
+            self.contest_problem_ids[contest_id_, index] = id_
@@ -0,0 +1,97 @@
+"""Migrates a database from the layout storing strings inline to the compact one.
+
+    python -m cfa.migrate cf.db --vacuum
+
+Submission.programming_language and Submission.testset used to be strings on every row and
+Problem.tags a stringified Python list. They are now ids into the ProgrammingLanguage and Testset
+name tables and rows of ProblemTag. download refuses to run on the old layout until it is
+migrated. The migration rebuilds the submission table in one transaction, so it needs about as
+much free disk as the database takes and runs for long on a large one; --vacuum afterwards gives
+the freed pages back to the filesystem.
+"""
+import argparse
+import ast
+import time
+
+from peewee import chunked
+from playhouse.migrate import SqliteMigrator, migrate as run_migrations
+
+from . import models
+from .models import Problem, ProblemTag, ProgrammingLanguage, Submission, Tag, Testset
+
+
+def needs_migration() -> bool:
+    columns = {column.name for column in models.db.get_columns('submission')}
+    return 'programming_language' in columns
+
+
+def migrate_compact():
+    """Moves the inline strings into the name tables, all in one transaction."""
+    start = time.monotonic()
+    db = models.db
+    db.create_tables([ProgrammingLanguage, Testset, Tag, ProblemTag])
+    with db.atomic():
+        for model, column in [(ProgrammingLanguage, 'programming_language'),
+                              (Testset, 'testset')]:
+            db.execute_sql(f'INSERT OR IGNORE INTO "{model._meta.table_name}" (name) '
+                           f'SELECT DISTINCT "{column}" FROM submission')
+
+        # Rebuilding the table in one INSERT ... SELECT is much faster than updating it in place
+        db.execute_sql('ALTER TABLE submission RENAME TO submission_old')
+        for index in db.get_indexes('submission_old'):
+            db.execute_sql(f'DROP INDEX "{index.name}"')
+        Submission.create_table()
+        columns = [field.column_name for field in Submission._meta.sorted_fields]
+        select = [f's."{column}"' for column in columns]
+        select[columns.index('programming_language_id')] = 'pl.id'
+        select[columns.index('testset_id')] = 't.id'
+        db.execute_sql(
+            f'INSERT INTO submission ({", ".join(columns)}) '
+            f'SELECT {", ".join(select)} FROM submission_old AS s '
+            f'JOIN programminglanguage AS pl ON pl.name = s.programming_language '
+            f'JOIN testset AS t ON t.name = s.testset')
+        db.execute_sql('DROP TABLE submission_old')
+        print('migrated submissions', f'{time.monotonic() - start:.2f}s')
+
+        tag_ids = {}
+        data = []
+        for problem_id, tags in db.execute_sql('SELECT id, tags FROM problem'):
+            # Stored as str() of the list by the old CharField
+            for tag in ast.literal_eval(tags):
+                if tag not in tag_ids:
+                    Tag.insert(name=tag).on_conflict_ignore().execute()
+                    tag_ids[tag] = Tag.get(Tag.name == tag).id
+                data.append((problem_id, tag_ids[tag]))
+        for piece in chunked(data, 5000):
+            (ProblemTag
+             .insert_many(piece, fields=[ProblemTag.problem, ProblemTag.tag])
+             .on_conflict_ignore()
+             .execute())
+        run_migrations(SqliteMigrator(db).drop_column(Problem._meta.table_name, 'tags'))
+        models.db.create_tables([models.DataVersion])
+        models.touch(Submission, ProgrammingLanguage, Testset, Problem, Tag, ProblemTag)
+    print('migrated', len(data), 'problem tags', f'{time.monotonic() - start:.2f}s')
+
+
+def migrate(vacuum: bool = False):
+    if needs_migration():
+        migrate_compact()
+        if vacuum:
+            models.db.execute_sql('VACUUM')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate a database to the compact layout')
+    parser.add_argument('db', nargs='?', default='cf.db')
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM after migrating')
+    args = parser.parse_args()
+    models.init(args.db)
+    models.connect()
+    if not needs_migration():
+        print('already compact')
+        return
+    migrate(args.vacuum)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
+import secrets
+from contextlib import contextmanager
 from enum import Enum, auto
 
-import requests
-from peewee import SqliteDatabase, Model
-from peewee import CharField, DateTimeField, ForeignKeyField, IntegerField, FloatField
+from peewee import SqliteDatabase, Model, SQL
+from peewee import BooleanField, CharField, DateTimeField, ForeignKeyField, IntegerField, FloatField
 
 # - Put a small max length on char fields (default is 255)
 # - Put lazy_load=False on foreign keys so that peewee doesn't auto query them when you forget to
@@ -41,11 +42,28 @@ class Contest(BaseModel):
     start_time = DateTimeField()
 
 
+class NameModel(BaseModel):
+    """Base of the tables dictionary-encoding strings that would otherwise repeat across many
+    rows, referred to by id."""
+    name = CharField(unique=True, max_length=64)
+
+
+class ProgrammingLanguage(NameModel):
+    pass
+
+
+class Testset(NameModel):
+    pass
+
+
+class Tag(NameModel):
+    pass
+
+
 class Problem(BaseModel):
     name = CharField(max_length=128)
     contest_start_time = DateTimeField()
     rating = IntegerField(null=True)
-    tags = CharField()
 
     class Meta:
         indexes = (
@@ -53,6 +71,16 @@ class Problem(BaseModel):
         )
 
 
+class ProblemTag(BaseModel):
+    problem = ForeignKeyField(Problem, lazy_load=False)
+    tag = ForeignKeyField(Tag, index=True, lazy_load=False)
+
+    class Meta:
+        indexes = (
+            (('problem', 'tag'), True),
+        )
+
+
 class ContestProblem(BaseModel):
     contest = ForeignKeyField(Contest, index=True, lazy_load=False)
     index = CharField(max_length=8)
@@ -70,9 +98,9 @@ class Submission(BaseModel):
     problem = ForeignKeyField(ContestProblem, lazy_load=False)
     author = ForeignKeyField(User, lazy_load=False)
     type = IntegerField()  # ParticipationType
-    programming_language = CharField(max_length=32)
+    programming_language = ForeignKeyField(ProgrammingLanguage, index=False, lazy_load=False)
     verdict = IntegerField()
-    testset = CharField(max_length=32)
+    testset = ForeignKeyField(Testset, index=False, lazy_load=False)
     passed_test_count = IntegerField()
 
     class Verdict(Enum):
@@ -162,16 +190,222 @@ class RatingChange(BaseModel):
         )
 
 
-def init(db_path):
-    db.init(db_path)
+# Per-user aggregates of the tables above, kept up to date by the aggregates module
+
+class SolvedProblem(BaseModel):
+    """Problems each user got accepted, in any contest the problem appeared in."""
+    user = ForeignKeyField(User, index=False, lazy_load=False)
+    problem = ForeignKeyField(Problem, lazy_load=False)
+
+    class Meta:
+        indexes = (
+            (('user', 'problem'), True),
+        )
+
+
+class UserStats(BaseModel):
+    user = ForeignKeyField(User, primary_key=True, lazy_load=False)
+    solved = IntegerField(constraints=[SQL('DEFAULT 0')])  # distinct problems
+    contests = IntegerField(constraints=[SQL('DEFAULT 0')])  # as a contestant
+    best_rank = IntegerField(null=True)  # as a contestant
+    max_rating_delta = IntegerField(null=True)
+    successful_hacks = IntegerField(constraints=[SQL('DEFAULT 0')])
+
+
+class UserSolvedByRating(BaseModel):
+    """Distinct problems solved by each user per problem rating; unrated problems are left out."""
+    user = ForeignKeyField(User, index=False, lazy_load=False)
+    rating = IntegerField()
+    solved = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('user', 'rating'), True),
+        )
+
+
+class UserSolvedByTag(BaseModel):
+    """Distinct problems solved by each user per problem tag."""
+    user = ForeignKeyField(User, index=False, lazy_load=False)
+    tag = ForeignKeyField(Tag, lazy_load=False)
+    solved = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('user', 'tag'), True),
+        )
+
+
+class SyncState(BaseModel):
+    """What was last downloaded from an API endpoint for a contest."""
+    contest = ForeignKeyField(Contest, lazy_load=False)
+    endpoint = CharField(max_length=32)  # e.g. 'contest.status'
+    fetched_at = DateTimeField()
+    contest_finished = BooleanField()  # whether the data can still change
+    max_submission_id = IntegerField(null=True)  # for contest.status
+
+    class Meta:
+        indexes = (
+            (('contest', 'endpoint'), True),
+        )
+
+
+class FailedRequest(BaseModel):
+    """Contest data that couldn't be fetched or written, even after retrying transient failures.
+    Removed once the contest is synced from the endpoint."""
+    contest = ForeignKeyField(Contest, lazy_load=False)
+    endpoint = CharField(max_length=32)
+    path = CharField(max_length=256)  # of the last failed call
+    error = CharField()
+    attempts = IntegerField()  # download runs that failed
+    failed_at = DateTimeField()
+
+    class Meta:
+        indexes = (
+            (('contest', 'endpoint'), True),
+        )
+
+
+class ChangedUser(BaseModel):
+    """Users whose data changed since achievements were last generated."""
+    user = ForeignKeyField(User, primary_key=True, lazy_load=False)
+
+
+class ChangedContest(BaseModel):
+    """Contests whose data changed since achievements were last generated."""
+    contest = ForeignKeyField(Contest, primary_key=True, lazy_load=False)
+
+
+class StoredGrant(BaseModel):
+    """Grants as of the last generation, which new grants are diffed against."""
+    achievement = CharField(max_length=128)  # title
+    handle = CharField(max_length=32)
+    info = CharField()
+
+    class Meta:
+        indexes = (
+            (('achievement', 'handle'), False),
+        )
+
+
+class GeneratedAchievement(BaseModel):
+    """Achievements whose grants are in StoredGrant."""
+    title = CharField(max_length=128, primary_key=True)
+    generated_at = DateTimeField()
+
+
+class UploadedDocument(BaseModel):
+    """Hash of the content of each document last uploaded to Cosmos DB."""
+    id = CharField(max_length=64, primary_key=True)
+    hash = CharField(max_length=64)
+
+
+class DataVersion(BaseModel):
+    """Random token per table, replaced whenever its rows change, for caches to check against."""
+    table = CharField(max_length=64, primary_key=True)
+    version = CharField(max_length=32)
+
+
+# Tables whose non-unique indexes ingest doesn't need, so bulk loads build them only after the
+# rows are in. Unique indexes stay, as they resolve conflicts and reject duplicate rows.
+DEFERRED_INDEX_MODELS = [Submission, Hack, RanklistRow, ProblemResult, RatingChange]
+
+BULK_LOAD_PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'off'),
+    ('cache_size', -(1 << 20)),  # 1 GiB
+    ('mmap_size', 1 << 30),
+    ('temp_store', 'memory'),
+]
+SAFE_PRAGMAS = [
+    ('journal_mode', 'delete'),
+    ('synchronous', 'full'),
+    ('cache_size', -2000),
+    ('mmap_size', 0),
+    ('temp_store', 'default'),
+]
+
+
+class _BulkLoad:
+    def __init__(self, txn, commit_every: int):
+        self.txn = txn
+        self.commit_every = commit_every
+        self.pending = 0
+
+    def checkpoint(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.txn.commit()
+            self.pending = 0
+
+_bulk_load = None
+
+@contextmanager
+def bulk_load(commit_every: int = 50):
+    """Tunes the database for loading many rows and restores safe settings afterwards.
+
+    Non-unique indexes of DEFERRED_INDEX_MODELS are dropped for the duration and rebuilt at the
+    end. Everything runs in one transaction that is committed every `commit_every` checkpoints,
+    so atomic() blocks inside become cheap savepoints.
+    """
+    global _bulk_load
+    for name, value in BULK_LOAD_PRAGMAS:
+        db.pragma(name, value)
+    try:
+        for model in DEFERRED_INDEX_MODELS:
+            for index in model._meta.fields_to_index():
+                if not index._unique:
+                    db.execute_sql(f'DROP INDEX IF EXISTS "{index._name}"')
+        try:
+            with db.atomic() as txn:
+                _bulk_load = _BulkLoad(txn, commit_every)
+                yield
+        finally:
+            _bulk_load = None
+            print('creating indexes')
+            for model in DEFERRED_INDEX_MODELS:
+                model._schema.create_indexes(safe=True)
+    finally:
+        for name, value in SAFE_PRAGMAS:
+            db.pragma(name, value)
+
+def in_bulk_load() -> bool:
+    return _bulk_load is not None
+
+def checkpoint():
+    """Marks the end of a unit of work, e.g. one contest. Commits every so often during a bulk
+    load, does nothing otherwise."""
+    if _bulk_load is not None:
+        _bulk_load.checkpoint()
+
+
+def init(db_path, read_only: bool = False):
+    if read_only:
+        db.init(f'file:{db_path}?mode=ro', uri=True)
+    else:
+        db.init(db_path)
 
 def connect():
     db.connect()
 
 def create_tables():
     db.create_tables([
-        User, Contest, Problem, ContestProblem, Submission, Hack, RanklistRow, ProblemResult,
-        RatingChange])
+        User, Contest, ProgrammingLanguage, Testset, Tag, Problem, ProblemTag, ContestProblem,
+        Submission, Hack, RanklistRow, ProblemResult, RatingChange, SolvedProblem, UserStats,
+        UserSolvedByRating, UserSolvedByTag, SyncState, FailedRequest, ChangedUser, ChangedContest,
+        StoredGrant, GeneratedAchievement, UploadedDocument, DataVersion])
+
+def touch(*models):
+    """Records that the rows of the given models' tables changed."""
+    data = [(model._meta.table_name, secrets.token_hex(8)) for model in models]
+    (DataVersion
+     .insert_many(data, fields=[DataVersion.table, DataVersion.version])
+     .on_conflict_replace()
+     .execute())
+
+def data_versions() -> dict:
+    """Current version of each table ever touched."""
+    return dict(DataVersion.select(DataVersion.table, DataVersion.version).tuples())
 
 def close():
     return db.close()
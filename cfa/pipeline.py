@@ -0,0 +1,231 @@
+"""Pipelined download: fetching, parsing and writing run concurrently instead of taking turns.
+
+    python -m cfa download --pipeline
+
+Responses are fetched by fetch_all's threads and spooled to files, a pool of processes decodes
+each file into row tuples, and the thread iterating over Pipeline.run writes them. The stages are
+connected by bounded queues, so a slow stage holds back the ones before it instead of letting
+work pile up: at most `queue_size` responses wait to be parsed or written, and fetch_all only
+starts calls as responses are taken. Each stage counts what went through it and how long it
+took, and the time fetching spent blocked on a full queue shows which side is the bottleneck.
+
+Parsed rows go through files too, pickled `chunk_size` rows at a time, and are read back a chunk
+at a time as they are written. So however large a response, memory holds no more than a chunk per
+worker and one being written; the responses and rows waiting in between are on disk.
+"""
+import gzip
+import itertools
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Tuple
+
+from . import api
+
+PARSE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+CHUNK_SIZE = 20000
+REPORT_EVERY = 60
+_DONE = object()
+
+
+class StageCounter:
+    """Items, rows and bytes through a pipeline stage, and the time it spent on them."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.items = 0
+        self.rows = 0
+        self.bytes = 0
+        self.busy = 0.0
+
+    def add(self, elapsed: float, rows: int = 0, nbytes: int = 0):
+        with self.lock:
+            self.items += 1
+            self.rows += rows
+            self.bytes += nbytes
+            self.busy += elapsed
+
+    def report(self, wall: float) -> str:
+        with self.lock:
+            wall = max(wall, 1e-9)
+            size = f'{self.bytes / 2**20:.1f} MiB, ' if self.bytes else ''
+            return (f'  {self.name}: {self.items} items, {self.rows} rows, {size}'
+                    f'{self.busy:.2f}s busy, {self.items / wall:.2f} items/s, '
+                    f'{self.rows / wall:.0f} rows/s')
+
+
+def open_spooled(file_path: str):
+    """Opens a file handed to a parse function, a spooled response or a gzipped cache file."""
+    return gzip.open(file_path, 'rb') if file_path.endswith('.gz') else open(file_path, 'rb')
+
+
+def _parse_file(parse: Callable[[str, Any], Iterator[tuple]], file_path: str, arg: Any,
+                owned: bool, directory: str, chunk_size: int) -> Tuple[str, int, Any, float]:
+    """Pickles the rows parsed from a file to a new file in `directory`, chunk_size at a time.
+    Returns that file, the number of rows, what parse returned and the time taken."""
+    start = time.monotonic()
+    extra = None
+
+    def rows():
+        nonlocal extra
+        extra = yield from parse(file_path, arg)
+
+    count = 0
+    try:
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as out:
+            try:
+                it = rows()
+                while piece := list(itertools.islice(it, chunk_size)):
+                    pickle.dump(piece, out, pickle.HIGHEST_PROTOCOL)
+                    count += len(piece)
+            except BaseException:
+                out.close()
+                os.remove(out.name)
+                raise
+        return out.name, count, extra, time.monotonic() - start
+    finally:
+        if owned:
+            os.remove(file_path)
+
+
+def _read_rows(rows_path: str) -> Iterator[tuple]:
+    with open(rows_path, 'rb') as fp:
+        while True:
+            try:
+                piece = pickle.load(fp)
+            except EOFError:
+                return
+            yield from piece
+
+
+class Pipeline:
+    """Fetch, parse and write stages for a list of API calls.
+
+    `parse(file_path, arg)` runs in a worker process, so it must be a module level function. It is
+    a generator yielding row tuples, whose return value is anything else the writer needs.
+    """
+
+    def __init__(self, parse: Callable[[str, Any], Iterator[tuple]],
+                 workers: int = PARSE_WORKERS, queue_size: int = None,
+                 chunk_size: int = CHUNK_SIZE):
+        self.parse = parse
+        self.workers = workers
+        self.queue_size = queue_size or 2 * workers
+        self.chunk_size = chunk_size
+        self.fetch = StageCounter('fetch')
+        self.parsed = StageCounter('parse')
+        self.write = StageCounter('write')
+        self.fetch_blocked = 0.0
+        self.started = time.monotonic()
+
+    def report(self) -> str:
+        wall = time.monotonic() - self.started
+        return '\n'.join([
+            self.fetch.report(wall),
+            f'    blocked {self.fetch_blocked:.2f}s on parsing and writing',
+            self.parsed.report(wall),
+            self.write.report(wall),
+        ])
+
+    def _spool(self, directory: str) -> Callable[[str], Tuple[str, bool]]:
+        def spool(path: str) -> Tuple[str, bool]:
+            start = time.monotonic()
+            if api.offline and api.cache is not None:
+                # Parse the cache file in place rather than copying it
+                file = api.cache.file_for(path)
+                if file.exists():
+                    self.fetch.add(time.monotonic() - start, nbytes=file.stat().st_size)
+                    return str(file), False
+            with api.api_get_stream(path) as fp, tempfile.NamedTemporaryFile(
+                    dir=directory, delete=False) as out:
+                shutil.copyfileobj(fp, out, api.STREAM_CHUNK_SIZE)
+            self.fetch.add(time.monotonic() - start, nbytes=os.path.getsize(out.name))
+            return out.name, True
+        return spool
+
+    def run(self, items: Iterable, path_of: Callable, arg_of: Callable = lambda item: item,
+            workers: int = api.MAX_IN_FLIGHT) -> Iterator[tuple]:
+        """Fetches `path_of(item)` for every item and parses the response with
+        `parse(file, arg_of(item))`.
+
+        Yields (item, (rows, extra), error) as parsed responses become ready, error being None on
+        success, rows being an iterator over the parsed rows that reads them from disk as it goes.
+        The caller writes the rows before taking the next one, which is counted as the write
+        stage.
+        """
+        self.started = time.monotonic()
+        ready = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        context = multiprocessing.get_context('spawn')
+
+        def put(entry) -> bool:
+            start = time.monotonic()
+            while not stop.is_set():
+                try:
+                    ready.put(entry, timeout=0.1)
+                    self.fetch_blocked += time.monotonic() - start
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        with tempfile.TemporaryDirectory() as directory, ProcessPoolExecutor(
+                self.workers, mp_context=context) as pool:
+            def feed():
+                try:
+                    for item, spooled, error in api.fetch_all(items, path_of, workers,
+                                                              fetch=self._spool(directory)):
+                        if error is None:
+                            file_path, owned = spooled
+                            entry = (item, pool.submit(_parse_file, self.parse, file_path,
+                                                       arg_of(item), owned, directory,
+                                                       self.chunk_size), None)
+                        else:
+                            entry = (item, None, error)
+                        if not put(entry):
+                            return
+                except BaseException as e:
+                    put((None, None, e))
+                finally:
+                    put(_DONE)
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            last_report = time.monotonic()
+            try:
+                while (entry := ready.get()) is not _DONE:
+                    item, future, error = entry
+                    if item is None:
+                        raise error
+                    result = rows_path = None
+                    count = 0
+                    if future is not None:
+                        try:
+                            rows_path, count, extra, elapsed = future.result()
+                            self.parsed.add(elapsed, rows=count)
+                            result = _read_rows(rows_path), extra
+                        except Exception as e:
+                            error = e
+                    start = time.monotonic()
+                    try:
+                        yield item, result, error
+                    finally:
+                        if rows_path is not None:
+                            result[0].close()
+                            os.remove(rows_path)
+                    self.write.add(time.monotonic() - start, rows=count)
+
+                    if time.monotonic() - last_report > REPORT_EVERY:
+                        last_report = time.monotonic()
+                        print(self.report())
+            finally:
+                stop.set()
+                feeder.join()
+        print(self.report())
@@ -0,0 +1,216 @@
+"""Instrumented achievement runs, to find out why an achievement is slow.
+
+    python -m cfa.profiling --report profile.json
+    python -m cfa.profiling --cprofile 'Legendary Grandmaster'
+
+The first evaluates every registered achievement with the database hooked and writes a JSON
+report with, per achievement (or family, as they are evaluated together), the wall and CPU time,
+peak memory allocated, SQLite VM steps and every distinct query issued with its count, time and
+EXPLAIN QUERY PLAN. The second runs one achievement under cProfile.
+"""
+import argparse
+import cProfile
+import json
+import pstats
+import sqlite3
+import time
+import tracemalloc
+from typing import Dict, List
+
+from . import achievements, models
+from .achievement import Achievement, registered_achievements
+from .generate import _evaluate, _group_units, _prepare_snapshot
+
+# Steps of the SQLite VM between calls of the progress handler used to count them
+VM_STEPS_PER_CALL = 1000
+
+
+class QueryStats:
+    def __init__(self, sql: str, params):
+        self.sql = sql
+        self.params = params
+        self.count = 0
+        self.elapsed = 0.0
+        self.plan: List[str] = []
+
+    def to_dict(self) -> dict:
+        return {
+            'sql': self.sql,
+            'count': self.count,
+            'elapsed': round(self.elapsed, 6),
+            'plan': self.plan,
+        }
+
+
+class QueryLog:
+    """Context manager recording the queries run on models.db while active.
+
+    Queries are grouped by SQL text. The time recorded is that of execute_sql, which for a SELECT
+    covers only the first step; rows fetched later are paid for in the caller's time, and counted
+    in `vm_steps`, the number of SQLite VM instructions run (in multiples of VM_STEPS_PER_CALL).
+    With `explain`, the query plan of each distinct query is looked up on exit.
+    """
+
+    def __init__(self, explain: bool = True):
+        self.explain = explain
+        self.queries: Dict[str, QueryStats] = {}
+        self.vm_steps = 0
+
+    def __enter__(self):
+        execute_sql = models.db.execute_sql
+
+        def hooked(sql, params=None, *args, **kwargs):
+            stats = self.queries.get(sql)
+            if stats is None:
+                stats = self.queries[sql] = QueryStats(sql, params)
+            start = time.perf_counter()
+            try:
+                return execute_sql(sql, params, *args, **kwargs)
+            finally:
+                stats.count += 1
+                stats.elapsed += time.perf_counter() - start
+
+        def progress():
+            self.vm_steps += VM_STEPS_PER_CALL
+            return 0
+
+        # An instance attribute shadows the method, and peewee calls it through the instance
+        self._previous = models.db.__dict__.get('execute_sql')
+        models.db.execute_sql = hooked
+        models.db.connection().set_progress_handler(progress, VM_STEPS_PER_CALL)
+        return self
+
+    def __exit__(self, *exc):
+        if self._previous is None:
+            del models.db.execute_sql
+        else:
+            models.db.execute_sql = self._previous
+        conn = models.db.connection()
+        conn.set_progress_handler(None, 0)
+        if self.explain:
+            for stats in self.queries.values():
+                stats.plan = explain(conn, stats.sql, stats.params)
+
+    @property
+    def query_count(self) -> int:
+        return sum(stats.count for stats in self.queries.values())
+
+    def to_list(self) -> List[dict]:
+        return [stats.to_dict()
+                for stats in sorted(self.queries.values(), key=lambda s: -s.elapsed)]
+
+
+def explain(conn: sqlite3.Connection, sql: str, params=None) -> List[str]:
+    """Returns the EXPLAIN QUERY PLAN of a query as indented lines."""
+    try:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()
+    except sqlite3.Error as e:
+        return [f'error: {e}']
+    depth = {0: -1}
+    lines = []
+    for id_, parent, _, detail in rows:
+        depth[id_] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[id_] + detail)
+    return lines
+
+
+def profile_unit(unit: List[Achievement], explain: bool = True) -> dict:
+    """Evaluates an achievement, or the members of a family, and returns its measurements."""
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    cpu_start = time.process_time()
+    with QueryLog(explain) as log:
+        grants, wall = _evaluate(unit)
+    cpu = time.process_time() - cpu_start
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    if not tracing:
+        tracemalloc.stop()
+
+    return {
+        'achievements': [ach.title for ach in unit],
+        'family': unit[0].family is not None,
+        'grants': [len(g) for g in grants],
+        'wall': round(wall, 6),
+        'cpu': round(cpu, 6),
+        'peak_memory': peak,
+        'query_count': log.query_count,
+        'vm_steps': log.vm_steps,
+        'queries': log.to_list(),
+    }
+
+
+def profile_achievements(db_path: str = 'cf.db', report_path: str = None,
+                         explain: bool = True) -> List[dict]:
+    """Profiles every registered achievement, printing a summary and writing the full report as
+    JSON to `report_path` if given. Memory tracing slows evaluation down, so times are only
+    comparable with each other, not with those of generate.get_achievements."""
+    if models.db.is_closed():
+        models.init(db_path, read_only=True)
+        models.connect()
+
+    achievements.load()
+    achs = registered_achievements()
+    _prepare_snapshot(db_path, achs)
+    report = []
+    for unit in _group_units(achs):
+        entry = profile_unit([achs[i] for i in unit], explain)
+        report.append(entry)
+        name = entry['achievements'][0] + (' (family)' if entry['family'] else '')
+        print(f"{name:<40} {entry['wall']:8.3f}s wall {entry['cpu']:8.3f}s cpu "
+              f"{entry['peak_memory'] / 2**20:8.1f} MiB {entry['query_count']:5} queries "
+              f"{entry['vm_steps']:>12} steps")
+
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump({'db': db_path, 'units': report}, f, indent=2)
+    return report
+
+
+def cprofile(title: str, db_path: str = 'cf.db', out_path: str = None, top: int = 30):
+    """Runs the achievement with the given title (with the rest of its family, if any) under
+    cProfile and prints the `top` functions by cumulative time. The raw stats are written to
+    `out_path` if given, for snakeviz and the like."""
+    if models.db.is_closed():
+        models.init(db_path, read_only=True)
+        models.connect()
+
+    achievements.load()
+    achs = registered_achievements()
+    for unit in _group_units(achs):
+        if any(achs[i].title == title for i in unit):
+            break
+    else:
+        raise KeyError('no achievement titled ' + title)
+    _prepare_snapshot(db_path, [achs[i] for i in unit])
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    _evaluate([achs[i] for i in unit])
+    profiler.disable()
+
+    if out_path is not None:
+        profiler.dump_stats(out_path)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile achievement generation')
+    parser.add_argument('--db', default='cf.db')
+    parser.add_argument('--report', default='profile.json', help='JSON report path')
+    parser.add_argument('--no-explain', action='store_true', help="don't look up query plans")
+    parser.add_argument('--cprofile', metavar='TITLE',
+                        help='run only this achievement under cProfile')
+    parser.add_argument('--cprofile-out', help='file to dump the cProfile stats to')
+    args = parser.parse_args()
+    if args.cprofile is not None:
+        cprofile(args.cprofile, args.db, args.cprofile_out)
+    else:
+        profile_achievements(args.db, args.report, explain=not args.no_explain)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+
+
+class RateLimiter:
+    """Token bucket refilled at `rate` tokens per second, holding at most `burst` tokens.
+
+    Each call takes `cost` tokens, e.g. 1 per request or its request unit charge. The tokens are
+    taken immediately and the caller waits out any shortfall, so the bucket can go into debt and
+    a call costing more than `burst` still goes through, delaying the calls after it. State is a
+    few numbers behind a lock, so one limiter can be shared by threads (acquire) and by asyncio
+    tasks (acquire_async).
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.started = self.updated
+        self.calls = 0
+        self.consumed = 0.0
+        self.waited = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _reserve(self, cost: float) -> float:
+        """Takes `cost` tokens, returning how long to wait before they are earned."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= cost
+            delay = max(0.0, -self.tokens / self.rate)
+            self.calls += 1
+            self.consumed += cost
+            self.waited += delay
+            return delay
+
+    def acquire(self, cost: float = 1):
+        delay = self._reserve(cost)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, cost: float = 1):
+        delay = self._reserve(cost)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def charge(self, cost: float):
+        """Adjusts the tokens without waiting, e.g. by the difference between a call's estimated
+        and actual cost once it is known. Negative costs refund tokens."""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens - cost)
+            self.consumed += cost
+
+    def pause(self, seconds: float):
+        """Makes the next calls wait at least `seconds`, e.g. for a retry-after."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def utilisation(self) -> float:
+        """Tokens consumed as a fraction of those made available since creation."""
+        elapsed = time.monotonic() - self.started
+        return max(0.0, self.consumed / (self.rate * elapsed + self.burst))
+
+    def report(self) -> str:
+        avg_wait = self.waited / self.calls if self.calls else 0.0
+        return (f'{self.calls} calls, {self.waited:.2f}s waited ({avg_wait:.3f}s avg), '
+                f'{self.utilisation():.0%} utilised')
+
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter whose bucket lives in shared memory, so that processes it is passed to when
+    they start (e.g. as a pool initializer argument) draw from one budget.
+
+    Only the tokens are shared; the rate and the call statistics stay per process.
+    """
+
+    def __init__(self, rate: float, burst: float = 1, context=multiprocessing):
+        self._state = context.Array('d', 2)  # tokens, updated
+        super().__init__(rate, burst)
+        self.lock = self._state.get_lock()
+
+    @property
+    def tokens(self) -> float:
+        return self._state[0]
+
+    @tokens.setter
+    def tokens(self, value: float):
+        self._state[0] = value
+
+    @property
+    def updated(self) -> float:
+        return self._state[1]
+
+    @updated.setter
+    def updated(self, value: float):
+        self._state[1] = value
@@ -0,0 +1,258 @@
+"""Sharded download of the per-contest stages, for ingest that isn't held back by one writer.
+
+    python -m cfa download --shards 4 [--bulk]
+
+The contests are partitioned by id range into shards with about the same number of contests to
+sync, and each shard is downloaded by its own process into its own database, <db>.shard<n>,
+with the models schema. Before downloading, a shard is seeded from the main database with all
+users, problems and names and with the contests of its range, their contest problems and sync
+state, so that user ids and the ids of already known problems agree with the main database and
+the stages run unchanged. All processes share one rate limit.
+
+The shards are then merged into the main database one after another. Problems, contest problems
+and names new in a shard get ids in the main database, matched by their natural keys (problem
+name and contest start time, contest and index, name), and the rows referring to them are
+remapped on the way. Shards are deleted once merged.
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+from . import api, download, models
+from .cache import ResponseCache
+from .lookup import Lookup
+from .models import User, Contest, ProgrammingLanguage, Testset, Tag, Problem
+from .models import ContestProblem, Submission, Hack, RanklistRow, ProblemResult, RatingChange
+from .models import SyncState, FailedRequest, ChangedContest
+from .ratelimit import SharedRateLimiter
+
+# SQLite attaches at most 10 databases by default, and the merge attaches all shards at once
+MAX_SHARDS = 8
+NAME_MODELS = [ProgrammingLanguage, Testset, Tag]
+
+
+class Shard(NamedTuple):
+    number: int
+    path: str
+    first_contest: Optional[int]  # None for unbounded
+    last_contest: Optional[int]
+
+    def where(self, column: str = 'id') -> str:
+        conditions = []
+        if self.first_contest is not None:
+            conditions.append(f'{column} >= {self.first_contest:d}')
+        if self.last_contest is not None:
+            conditions.append(f'{column} <= {self.last_contest:d}')
+        return ' AND '.join(conditions) or '1'
+
+    def contains(self, contest_id: int) -> bool:
+        return ((self.first_contest is None or contest_id >= self.first_contest) and
+                (self.last_contest is None or contest_id <= self.last_contest))
+
+
+def shard_path(db_path: str, number: int) -> str:
+    return f'{db_path}.shard{number}'
+
+
+def partition(db_path: str, shards: int, stages: List[str], phases: Dict[int, str],
+              incremental: bool, retry_failed: bool) -> List[Shard]:
+    """Splits the contest ids into up to `shards` ranges with about as many contests to sync each.
+    The ranges cover all ids, as incremental submission downloads also visit synced contests."""
+    pending = sorted({c.id for stage in stages
+                      for c in download.contests_to_sync(download.STAGE_ENDPOINTS[stage], phases,
+                                                         incremental, retry_failed)})
+    shards = max(1, min(shards, len(pending)))
+    bounds = [pending[len(pending) * (n + 1) // shards - 1] for n in range(shards - 1)]
+    firsts = [None] + [bound + 1 for bound in bounds]
+    lasts = bounds + [None]
+    return [Shard(n, shard_path(db_path, n), first, last)
+            for n, (first, last) in enumerate(zip(firsts, lasts))]
+
+
+def _remove(path: str):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _columns(model, exclude_id: bool = False) -> List[str]:
+    return [f'"{field.column_name}"' for field in model._meta.sorted_fields
+            if not (exclude_id and field.primary_key)]
+
+
+def _copy(model, source: str, target: str = 'main', where: str = '1', verb: str = 'INSERT'):
+    table = model._meta.table_name
+    columns = ', '.join(_columns(model))
+    models.db.execute_sql(f'{verb} INTO {target}."{table}" ({columns}) '
+                          f'SELECT {columns} FROM {source}."{table}" WHERE {where}')
+
+
+def _seed(shard: Shard, db_path: str):
+    """Copies what the stages of a shard read from the main database into the shard."""
+    models.db.execute_sql('ATTACH DATABASE ? AS source', (db_path,))
+    try:
+        with models.db.atomic():
+            for model in [User, Problem] + NAME_MODELS:
+                _copy(model, 'source')
+            _copy(Contest, 'source', where=shard.where())
+            for model in [ContestProblem, SyncState, FailedRequest]:
+                _copy(model, 'source', where=shard.where('contest_id'))
+    finally:
+        models.db.execute_sql('DETACH DATABASE source')
+
+
+def _init_worker(limiter: SharedRateLimiter, cache_dir: Optional[str], offline: bool):
+    api.limiter = limiter
+    if cache_dir is not None:
+        api.cache = ResponseCache(cache_dir)
+    api.offline = offline
+
+
+def _download_shard(shard: Shard, db_path: str, stages: List[str], phases: Dict[int, str],
+                    incremental: bool, retry_failed: bool) -> Dict[str, float]:
+    _remove(shard.path)
+    models.init(shard.path)
+    models.connect()
+    models.create_tables()
+    timings = {}
+    start = time.monotonic()
+    _seed(shard, db_path)
+    timings['seed'] = time.monotonic() - start
+
+    lookup = Lookup()
+    # A shard is a fresh database, so it is always written in bulk mode
+    with models.bulk_load():
+        for stage in stages:
+            start = time.monotonic()
+            download.CONTEST_STAGES[stage](lookup, phases, incremental, retry_failed)
+            timings[stage] = time.monotonic() - start
+    models.db.close()
+    print(f'shard {shard.number} done')
+    print(api.stats.report())
+    return timings
+
+
+def _map_table(name: str, source: str, target: str, on: str):
+    """Temp table mapping the ids of rows in the shard to those of the same rows in main."""
+    models.db.execute_sql(f'DROP TABLE IF EXISTS temp.{name}')
+    models.db.execute_sql(f'CREATE TEMP TABLE {name} (old INTEGER PRIMARY KEY, new INTEGER)')
+    models.db.execute_sql(f'INSERT INTO temp.{name} SELECT s.id, m.id FROM {source} AS s '
+                          f'JOIN {target} AS m ON {on}')
+
+
+def _merge(schema: str, stages: List[str]):
+    """Merges an attached shard into the main database."""
+    db = models.db
+    s = schema
+
+    for model in NAME_MODELS:
+        table = model._meta.table_name
+        db.execute_sql(f'INSERT OR IGNORE INTO main."{table}" (name) '
+                       f'SELECT name FROM {s}."{table}"')
+        _map_table(f'{table}_map', f'{s}."{table}"', f'main."{table}"', 'm.name = s.name')
+
+    columns = ', '.join(_columns(Problem, exclude_id=True))
+    db.execute_sql(f'INSERT OR IGNORE INTO main.problem ({columns}) '
+                   f'SELECT {columns} FROM {s}.problem')
+    _map_table('problem_map', f'{s}.problem', 'main.problem',
+               'm.name = s.name AND m.contest_start_time = s.contest_start_time')
+    db.execute_sql('INSERT OR IGNORE INTO main.problemtag (problem_id, tag_id) '
+                   f'SELECT pm.new, tm.new FROM {s}.problemtag AS s '
+                   'JOIN temp.problem_map AS pm ON pm.old = s.problem_id '
+                   'JOIN temp.tag_map AS tm ON tm.old = s.tag_id')
+    db.execute_sql('INSERT OR IGNORE INTO main.contestproblem (contest_id, "index", problem_id) '
+                   f'SELECT s.contest_id, s."index", pm.new FROM {s}.contestproblem AS s '
+                   'JOIN temp.problem_map AS pm ON pm.old = s.problem_id')
+    _map_table('contestproblem_map', f'{s}.contestproblem', 'main.contestproblem',
+               'm.contest_id = s.contest_id AND m."index" = s."index"')
+
+    # Contests synced by the shard, as opposed to sync state copied in by _seed
+    db.execute_sql('DROP TABLE IF EXISTS temp.synced')
+    db.execute_sql(f'CREATE TEMP TABLE synced AS SELECT s.* FROM {s}.syncstate AS s '
+                   'LEFT JOIN main.syncstate AS m '
+                   'ON m.contest_id = s.contest_id AND m.endpoint = s.endpoint '
+                   'WHERE m.id IS NULL OR m.fetched_at != s.fetched_at')
+
+    # Rows with API ids are replaced, as when a running contest is fetched again
+    db.execute_sql(
+        f'INSERT OR REPLACE INTO main.submission ({", ".join(_columns(Submission))}) '
+        'SELECT s.id, s.contest_id, cp.new, s.author_id, s.type, pl.new, s.verdict, t.new, '
+        f's.passed_test_count FROM {s}.submission AS s '
+        'JOIN temp.contestproblem_map AS cp ON cp.old = s.problem_id '
+        'JOIN temp.programminglanguage_map AS pl ON pl.old = s.programming_language_id '
+        'JOIN temp.testset_map AS t ON t.old = s.testset_id')
+    db.execute_sql(
+        f'INSERT OR REPLACE INTO main.hack ({", ".join(_columns(Hack))}) '
+        'SELECT s.id, s.contest_id, cp.new, s.hacker_id, s.defender_id, s.verdict '
+        f'FROM {s}.hack AS s JOIN temp.contestproblem_map AS cp ON cp.old = s.problem_id')
+    # Rows without API ids are replaced contest by contest, as download does
+    for endpoint, row_models in [('contest.standings', [RanklistRow, ProblemResult]),
+                                 ('contest.ratingChanges', [RatingChange])]:
+        for model in row_models:
+            table = model._meta.table_name
+            db.execute_sql(f'DELETE FROM main."{table}" WHERE contest_id IN '
+                           '(SELECT contest_id FROM temp.synced WHERE endpoint = ?)', (endpoint,))
+            columns = ', '.join(_columns(model, exclude_id=True))
+            db.execute_sql(f'INSERT INTO main."{table}" ({columns}) '
+                           f'SELECT {columns} FROM {s}."{table}"')
+
+    columns = ', '.join(_columns(SyncState, exclude_id=True))
+    db.execute_sql(f'INSERT OR REPLACE INTO main.syncstate ({columns}) '
+                   f'SELECT {columns} FROM temp.synced')
+    # The shard's retry queue started as a copy of main's for its contests
+    db.execute_sql(f'DELETE FROM main.failedrequest WHERE contest_id IN '
+                   f'(SELECT id FROM {s}.contest)')
+    columns = ', '.join(_columns(FailedRequest, exclude_id=True))
+    db.execute_sql(f'INSERT INTO main.failedrequest ({columns}) '
+                   f'SELECT {columns} FROM {s}.failedrequest')
+    _copy(ChangedContest, s, verb='INSERT OR IGNORE')
+
+    models.touch(*{model for stage in stages
+                   for model in download.ENDPOINT_MODELS[download.STAGE_ENDPOINTS[stage]]})
+
+
+def merge(shards: List[Shard], stages: List[str], bulk: bool = False):
+    """Merges the shards into the main database in one transaction, in models.bulk_load mode
+    with `bulk`, and deletes them."""
+    for shard in shards:
+        # ATTACH isn't allowed inside a transaction, so all are attached up front
+        models.db.execute_sql('ATTACH DATABASE ? AS ?', (shard.path, f'shard{shard.number}'))
+    try:
+        with (models.bulk_load() if bulk else models.db.atomic()):
+            for shard in shards:
+                start = time.monotonic()
+                _merge(f'shard{shard.number}', stages)
+                print('merged shard', shard.number, f'{time.monotonic() - start:.2f}s')
+    finally:
+        for shard in shards:
+            models.db.execute_sql('DETACH DATABASE ?', (f'shard{shard.number}',))
+    for shard in shards:
+        _remove(shard.path)
+
+
+def download_sharded(db_path: str, shards: int, stages: List[str], phases: Dict[int, str],
+                     incremental: bool = False, retry_failed: bool = False, bulk: bool = False,
+                     cache_dir: Optional[str] = None, offline: bool = False):
+    """Runs the given contest stages of download in up to `shards` processes and merges the
+    results into the main database, which must be connected."""
+    if shards > MAX_SHARDS:
+        raise ValueError(f'at most {MAX_SHARDS} shards are supported')
+    parts = partition(db_path, shards, stages, phases, incremental, retry_failed)
+    # Spawn rather than fork so that workers don't inherit the parent's sqlite connection
+    context = multiprocessing.get_context('spawn')
+    limiter = SharedRateLimiter(api.limiter.rate, api.limiter.burst, context)
+    with ProcessPoolExecutor(len(parts), mp_context=context, initializer=_init_worker,
+                             initargs=(limiter, cache_dir, offline)) as executor:
+        futures = [executor.submit(_download_shard, shard, db_path, stages,
+                                   {id_: phase for id_, phase in phases.items()
+                                    if shard.contains(id_)},
+                                   incremental, retry_failed)
+                   for shard in parts]
+        for shard, future in zip(parts, futures):
+            timings = future.result()
+            print(f'shard {shard.number}:',
+                  ' '.join(f'{name} {elapsed:.2f}s' for name, elapsed in timings.items()))
+    merge(parts, stages, bulk)
+
@@ -0,0 +1,168 @@
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class Throttled(Exception):
+    """Raised by a sink when the write was rejected for exceeding the throughput."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f'throttled, retry after {retry_after:.3f}s')
+        self.retry_after = retry_after
+
+
+class Sink(abc.ABC):
+    """Destination of the documents written by cosmos.save.
+
+    upsert is called from several threads at once and returns the request unit charge of the
+    write, or raises Throttled.
+
+    With `skip_unchanged`, save only writes documents changed since they were last written to a
+    sink of this kind, going by the hashes in UploadedDocument, and deletes those it doesn't make
+    anymore, so such sinks must also implement delete. Other sinks get every document.
+    """
+
+    skip_unchanged = False
+
+    @abc.abstractmethod
+    def upsert(self, doc: dict) -> float:
+        pass
+
+    def delete(self, doc_id: str) -> float:
+        """Deletes a document, returning the request unit charge, or raises Throttled."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def get_client():
+    from azure.cosmos import CosmosClient
+
+    conn_str = os.environ['AZURE_COSMOS_CONN_STRING']
+    client = CosmosClient.from_connection_string(conn_str=conn_str)
+    database = client.get_database_client('database1')
+    container = database.get_container_client('container2')
+    return container
+
+
+class CosmosSink(Sink):
+    skip_unchanged = True
+
+    def __init__(self, container=None):
+        self.container = container or get_client()
+
+    def upsert(self, doc: dict) -> float:
+        return self._call(lambda hook: self.container.upsert_item(doc, response_hook=hook))
+
+    def delete(self, doc_id: str) -> float:
+        # The container is partitioned by id
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+        try:
+            return self._call(lambda hook: self.container.delete_item(
+                doc_id, partition_key=doc_id, response_hook=hook))
+        except CosmosResourceNotFoundError:
+            return 0.0
+
+    def _call(self, call) -> float:
+        from azure.cosmos.exceptions import CosmosHttpResponseError
+
+        charge = 0.0
+        def hook(headers, _):
+            nonlocal charge
+            charge = float(headers.get('x-ms-request-charge', 0))
+
+        try:
+            call(hook)
+        except CosmosHttpResponseError as e:
+            if e.status_code == 429:
+                raise Throttled(float(e.headers.get('x-ms-retry-after-ms', 1000)) / 1000) from e
+            raise
+        return charge
+
+
+class JsonlSink(Sink):
+    """Writes documents to a JSON lines file, replacing what an earlier save wrote there. save
+    writes every document once, so the file holds the latest version of each."""
+
+    def __init__(self, path: str):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def upsert(self, doc: dict) -> float:
+        line = json.dumps(doc, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+        return 0.0
+
+    def close(self):
+        self.file.close()
+
+
+class SqliteSink(Sink):
+    """Keeps the latest version of each document in an SQLite table."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS doc (id TEXT PRIMARY KEY, body TEXT)')
+        self.lock = threading.Lock()
+
+    def upsert(self, doc: dict) -> float:
+        body = json.dumps(doc, separators=(',', ':'))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO doc VALUES (?, ?)', (doc['id'], body))
+        return 0.0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class FakeCosmosSink(Sink):
+    """In-process stand-in for a Cosmos DB container, for measuring and tuning saves offline.
+
+    Writes are charged request units by document size, roughly like Cosmos DB does, against
+    `ru_per_sec` of provisioned throughput per one-second window. Like Cosmos DB, a write is
+    accepted as long as the window isn't used up yet, even if its charge takes the window into
+    debt; later writes are rejected with Throttled until the debt is paid off by the following
+    windows. So a document charged more than `ru_per_sec` still goes through. `latency` seconds
+    are slept per write to stand in for the round trip.
+    """
+
+    def __init__(self, ru_per_sec: float = 400, latency: float = 0.0,
+                 base_charge: float = 5.5, charge_per_kb: float = 1.9):
+        self.ru_per_sec = ru_per_sec
+        self.latency = latency
+        self.base_charge = base_charge
+        self.charge_per_kb = charge_per_kb
+        self.docs = {}
+        self.lock = threading.Lock()
+        self.window = 0
+        self.window_charge = 0.0
+        self.total_charge = 0.0
+        self.throttled = 0
+
+    def upsert(self, doc: dict) -> float:
+        if self.latency:
+            time.sleep(self.latency)
+        body = json.dumps(doc, separators=(',', ':'))
+        charge = self.base_charge + self.charge_per_kb * len(body) / 1024
+        with self.lock:
+            now = time.monotonic()
+            if int(now) != self.window:
+                # Each window that passed pays off ru_per_sec of what was charged before it
+                paid = self.ru_per_sec * (int(now) - self.window)
+                self.window_charge = max(0.0, self.window_charge - paid)
+                self.window = int(now)
+            if self.window_charge >= self.ru_per_sec:
+                self.throttled += 1
+                debt_windows = (self.window_charge - self.ru_per_sec) // self.ru_per_sec
+                raise Throttled(self.window + 1 - now + debt_windows)
+            self.window_charge += charge
+            self.total_charge += charge
+            self.docs[doc['id']] = body
+        return charge
@@ -0,0 +1,248 @@
+"""Columnar snapshot of the database for vectorised achievements.
+
+Each table is exported to a directory of .npy files, one per column, which are memory-mapped
+when read, so the OS page cache is shared by every process using the snapshot. Integer and
+foreign key columns are int64 (NULL becomes -1), datetimes are int64 Unix seconds, floats are
+float64 and strings are dictionary-encoded: an int32 code per row indexing into a list of the
+distinct values, stored as JSON next to the codes. Rows are in primary key order.
+
+An achievement registered with snapshot=True gets the current Snapshot as the `snapshot` keyword
+argument:
+
+    @register(title='Polyglot', brief='Get accepted in 5 languages', snapshot=True)
+    def polyglot(snapshot):
+        subs = snapshot['submission']
+        ok = subs['verdict'] == Submission.Verdict.OK.value
+        pairs = np.unique(
+            np.stack([subs['author_id'][ok], subs['programming_language_id'][ok]]), axis=1)
+        authors, counts = np.unique(pairs[0], return_counts=True)
+        winners = authors[counts >= 5]
+        return [Grant(h, '') for h in snapshot.handles(winners)]
+
+generate exports the snapshot when one of its achievements needs it and the exported tables
+changed since the last export, going by their versions in DataVersion.
+"""
+import json
+import os
+import shutil
+from typing import Dict, List, Optional
+
+import numpy as np
+from peewee import BooleanField, CharField, DateTimeField, FloatField, ForeignKeyField
+from peewee import IntegerField, Model
+
+from . import models
+
+SNAPSHOT_MODELS = [
+    models.User, models.Contest, models.ProgrammingLanguage, models.Testset, models.Tag,
+    models.Problem, models.ProblemTag, models.ContestProblem, models.Submission, models.Hack,
+    models.RanklistRow, models.ProblemResult, models.RatingChange,
+]
+FETCH_ROWS = 100000
+META_FILE = 'meta.json'
+# Bump when the layout changes so that old snapshots are exported again
+FORMAT_VERSION = 2
+
+_current: Optional['Snapshot'] = None
+
+
+def snapshot_path(db_path: str) -> str:
+    return db_path + '.snapshot'
+
+
+def _column_kind(field) -> str:
+    if isinstance(field, (IntegerField, ForeignKeyField)):
+        return 'int'
+    if isinstance(field, DateTimeField):
+        return 'datetime'
+    if isinstance(field, FloatField):
+        return 'float'
+    if isinstance(field, BooleanField):
+        return 'bool'
+    if isinstance(field, CharField):
+        return 'str'
+    raise TypeError(f'cannot snapshot {field}')
+
+
+def _versions() -> Dict[str, Optional[str]]:
+    """DataVersion tokens of the exported tables, which download replaces whenever it writes to
+    them. Writes to other tables, e.g. by generate or save, leave them alone."""
+    versions = models.data_versions() if models.DataVersion.table_exists() else {}
+    return {model._meta.table_name: versions.get(model._meta.table_name)
+            for model in SNAPSHOT_MODELS}
+
+
+def export(db_path: str, path: str = None):
+    """Exports the tables in SNAPSHOT_MODELS from the connected database to `path`, replacing any
+    previous snapshot there once complete."""
+    path = path or snapshot_path(db_path)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    meta = {'format': FORMAT_VERSION, 'tables': {}}
+    conn = models.db.connection()
+    # Versions read in the same transaction as the rows, so that they match
+    with models.db.atomic():
+        meta['versions'] = _versions()
+        for model in SNAPSHOT_MODELS:
+            meta['tables'][model._meta.table_name] = _export_table(conn, model, tmp_path)
+
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def _export_table(conn, model: Model, path: str) -> dict:
+    table = model._meta.table_name
+    fields = model._meta.sorted_fields
+    kinds = [_column_kind(field) for field in fields]
+    select = []
+    for field, kind in zip(fields, kinds):
+        column = f'"{field.column_name}"'
+        if kind == 'datetime':
+            column = f"CAST(strftime('%s', {column}) AS INTEGER)"
+        elif kind == 'int':
+            column = f'IFNULL({column}, -1)'
+        select.append(column)
+    pk = f'"{model._meta.primary_key.column_name}"'
+    count, = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()
+
+    arrays, dictionaries = [], []
+    for field, kind in zip(fields, kinds):
+        dtype = {'int': np.int64, 'datetime': np.int64, 'float': np.float64, 'bool': np.bool_,
+                 'str': np.int32}[kind]
+        filename = os.path.join(path, f'{table}.{field.column_name}.npy')
+        arrays.append(np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                                shape=(count,)))
+        dictionaries.append({} if kind == 'str' else None)
+
+    cursor = conn.execute(f'SELECT {", ".join(select)} FROM "{table}" ORDER BY {pk}')
+    offset = 0
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        end = offset + len(rows)
+        for array, dictionary, values in zip(arrays, dictionaries, zip(*rows)):
+            if dictionary is not None:
+                values = [dictionary.setdefault(v, len(dictionary)) for v in values]
+            array[offset:end] = values
+        offset = end
+    assert offset == count, (table, offset, count)
+
+    columns = {}
+    for field, kind, array, dictionary in zip(fields, kinds, arrays, dictionaries):
+        array.flush()
+        columns[field.column_name] = kind
+        if dictionary is not None:
+            with open(os.path.join(path, f'{table}.{field.column_name}.json'), 'w') as f:
+                json.dump(list(dictionary), f)
+    return {'rows': count, 'columns': columns}
+
+
+class Table:
+    """Columns of one exported table, memory-mapped on first access."""
+
+    def __init__(self, path: str, name: str, meta: dict):
+        self.path = path
+        self.name = name
+        self.rows = meta['rows']
+        self.columns: Dict[str, str] = meta['columns']
+        self._arrays: Dict[str, np.ndarray] = {}
+        self._dictionaries: Dict[str, List[str]] = {}
+        self._codes: Dict[str, Dict[str, int]] = {}
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        array = self._arrays.get(column)
+        if array is None:
+            if column not in self.columns:
+                raise KeyError(f'{self.name} has no column {column}')
+            array = np.load(os.path.join(self.path, f'{self.name}.{column}.npy'), mmap_mode='r')
+            self._arrays[column] = array
+        return array
+
+    def dictionary(self, column: str) -> List[str]:
+        """Distinct values of a string column, indexed by code."""
+        dictionary = self._dictionaries.get(column)
+        if dictionary is None:
+            if self.columns.get(column) != 'str':
+                raise KeyError(f'{self.name}.{column} is not a string column')
+            with open(os.path.join(self.path, f'{self.name}.{column}.json')) as f:
+                dictionary = self._dictionaries[column] = json.load(f)
+        return dictionary
+
+    def code(self, column: str, value: str) -> int:
+        """Code of a value of a string column, or -1 if it doesn't occur."""
+        codes = self._codes.get(column)
+        if codes is None:
+            codes = self._codes[column] = {v: i for i, v in enumerate(self.dictionary(column))}
+        return codes.get(value, -1)
+
+    def decode(self, column: str, codes) -> List[str]:
+        dictionary = self.dictionary(column)
+        return [dictionary[code] for code in codes]
+
+
+class Snapshot:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.tables = {name: Table(path, name, table_meta)
+                       for name, table_meta in self.meta['tables'].items()}
+        self._user_rows = None
+
+    def __getitem__(self, table: str) -> Table:
+        return self.tables[table]
+
+    def handles(self, user_ids) -> List[str]:
+        """Handles of the users with the given ids."""
+        users = self['user']
+        if self._user_rows is None:
+            ids = users['id']
+            self._user_rows = np.full(int(ids.max(initial=0)) + 1, -1, dtype=np.int64)
+            self._user_rows[ids] = np.arange(len(ids))
+        rows = self._user_rows[np.asarray(user_ids, dtype=np.int64)]
+        return users.decode('handle', users['handle'][rows])
+
+    def is_fresh(self) -> bool:
+        """Whether none of the exported tables of the connected database changed since."""
+        return (self.meta.get('format') == FORMAT_VERSION
+                and self.meta.get('versions') == _versions())
+
+
+def prepare(db_path: str, path: str = None) -> Snapshot:
+    """Makes the snapshot of the connected database at `path` current, exporting it first if
+    missing or stale."""
+    path = path or snapshot_path(db_path)
+    try:
+        snapshot = Snapshot(path)
+    except FileNotFoundError:
+        snapshot = None
+    if snapshot is None or not snapshot.is_fresh():
+        print('exporting snapshot to', path)
+        export(db_path, path)
+        snapshot = Snapshot(path)
+    return _set_current(snapshot)
+
+
+def use(path: str) -> Snapshot:
+    """Makes the snapshot at `path` current without checking that it is fresh."""
+    return _set_current(Snapshot(path))
+
+
+def _set_current(snapshot: Snapshot) -> Snapshot:
+    global _current
+    _current = snapshot
+    return snapshot
+
+
+def current() -> Snapshot:
+    if _current is None:
+        raise RuntimeError('no snapshot prepared')
+    return _current
@@ -0,0 +1,182 @@
+import datetime as dt
+import itertools
+import json
+import random
+
+from .cache import ResponseCache
+
+# (exclusive upper rating bound, rank)
+RANKS = [
+    (1200, 'newbie'),
+    (1400, 'pupil'),
+    (1600, 'specialist'),
+    (1900, 'expert'),
+    (2100, 'candidate master'),
+    (2300, 'master'),
+    (2400, 'international master'),
+    (2600, 'grandmaster'),
+    (3000, 'international grandmaster'),
+    (None, 'legendary grandmaster'),
+]
+LANGUAGES = {
+    'GNU C++17': 45, 'GNU C++20 (64)': 25, 'Python 3': 8, 'PyPy 3-64': 8, 'Java 11': 7,
+    'Kotlin 1.7': 3, 'Rust 2021': 2, 'C# 10': 2,
+}
+REJECTED_VERDICTS = {
+    'WRONG_ANSWER': 60, 'TIME_LIMIT_EXCEEDED': 20, 'RUNTIME_ERROR': 10,
+    'COMPILATION_ERROR': 6, 'MEMORY_LIMIT_EXCEEDED': 4,
+}
+TAGS = [
+    'implementation', 'math', 'greedy', 'dp', 'data structures', 'brute force',
+    'constructive algorithms', 'graphs', 'sortings', 'binary search', 'dfs and similar', 'trees',
+    'strings', 'number theory', 'combinatorics', 'two pointers', 'bitmasks', 'geometry',
+]
+PROBLEM_INDICES = 'ABCDEF'
+FIRST_CONTEST_START = dt.datetime(2015, 1, 1)
+
+
+def rank_for(rating: int) -> str:
+    for bound, rank in RANKS:
+        if bound is None or rating < bound:
+            return rank
+
+
+def generate(cache_dir: str, users: int = 10000, contests: int = 200, seed: int = 0):
+    """Writes a seeded synthetic Codeforces dataset to a ResponseCache as API responses.
+
+    Load it with download.main(db_path, cache_dir=cache_dir, offline=True). Ratings are normally
+    distributed, activity is heavy-tailed, contest participation is 5-30% of users, solve
+    chances follow the Elo formula against problem ratings and languages and verdicts are
+    weighted like on the real site.
+    """
+    rng = random.Random(seed)
+    cache = ResponseCache(cache_dir)
+
+    def put(path, result):
+        body = json.dumps({'status': 'OK', 'result': result}, separators=(',', ':'))
+        cache.put(path, body.encode())
+
+    handles = [f'user{i}' for i in range(users)]
+    ratings = [min(3800, max(0, int(rng.gauss(1400, 350)))) for _ in range(users)]
+    max_ratings = list(ratings)
+    activity = [rng.paretovariate(1.5) for _ in range(users)]
+    cum_activity = list(itertools.accumulate(activity))
+    languages = [rng.choices(list(LANGUAGES), list(LANGUAGES.values()))[0] for _ in range(users)]
+    submission_id = 1
+    contest_list = []
+
+    for contest_id in range(1, contests + 1):
+        start = FIRST_CONTEST_START + dt.timedelta(days=4 * contest_id)
+        start_seconds = int(start.replace(tzinfo=dt.timezone.utc).timestamp())
+        contest_list.append(dict(
+            id=contest_id, name=f'Synthetic Round {contest_id}', phase='FINISHED',
+            startTimeSeconds=start_seconds))
+
+        offset = rng.choice([-300, -100, 0, 100, 300])
+        problems = [
+            dict(index=index, name=f'Problem {contest_id}{index}',
+                 rating=max(800, 800 + 300 * i + offset),
+                 tags=rng.sample(TAGS, rng.randint(1, 4)))
+            for i, index in enumerate(PROBLEM_INDICES)]
+
+        k = max(2, int(users * rng.uniform(0.05, 0.3)))
+        participants = _weighted_sample(rng, range(users), activity, k)
+        performance = {u: ratings[u] + rng.gauss(0, 200) for u in participants}
+        participants.sort(key=performance.get, reverse=True)
+
+        rows, subs, scored = [], [], []
+        for u in participants:
+            results, solved, penalty = [], 0, 0
+            for p in problems:
+                chance = 1 / (1 + 10 ** ((p['rating'] - performance[u]) / 400))
+                rejected = 0
+                while rng.random() > max(chance, 0.05) and rejected < 5:
+                    rejected += 1
+                accepted = rng.random() < chance
+                if not accepted and rng.random() < 0.5:
+                    rejected = 0  # not attempted
+                time_seconds = rng.randint(60, 7200)
+                for _ in range(rejected):
+                    subs.append((u, p['index'], rng.choices(
+                        list(REJECTED_VERDICTS), list(REJECTED_VERDICTS.values()))[0]))
+                if accepted:
+                    subs.append((u, p['index'], 'OK'))
+                    solved += 1
+                    penalty += time_seconds // 60 + 10 * rejected
+                results.append(dict(
+                    points=1.0 if accepted else 0.0, rejectedAttemptCount=rejected,
+                    penalty=time_seconds // 60 if accepted else 0,
+                    bestSubmissionTimeSeconds=time_seconds if accepted else 0))
+            scored.append((u, solved, penalty, results))
+
+        scored.sort(key=lambda x: (-x[1], x[2]))
+        hacks = []
+        for rank, (u, solved, penalty, results) in enumerate(scored, 1):
+            successful = 1 if rng.random() < 0.02 else 0
+            if successful:
+                hacks.append(dict(
+                    id=contest_id * 100000 + len(hacks),
+                    hacker=dict(members=[dict(handle=handles[u])]),
+                    defender=dict(members=[dict(handle=handles[rng.choice(participants)])]),
+                    problem=dict(index=rng.choice(PROBLEM_INDICES[:3])),
+                    verdict='HACK_SUCCESSFUL'))
+            rows.append(dict(
+                party=dict(members=[dict(handle=handles[u])], participantType='CONTESTANT'),
+                rank=rank, points=float(solved), penalty=penalty,
+                successfulHackCount=successful, unsuccessfulHackCount=0,
+                problemResults=results))
+
+        # Practice submissions after the contest
+        for u in rng.choices(range(users), cum_weights=cum_activity, k=len(subs) // 5):
+            verdict = 'OK' if rng.random() < 0.4 else rng.choices(
+                list(REJECTED_VERDICTS), list(REJECTED_VERDICTS.values()))[0]
+            subs.append((u, rng.choice(PROBLEM_INDICES), verdict, 'PRACTICE'))
+
+        status = []
+        for u, index, verdict, *typ in subs:
+            status.append(dict(
+                id=submission_id, contestId=contest_id, problem=dict(index=index),
+                author=dict(members=[dict(handle=handles[u])],
+                            participantType=typ[0] if typ else 'CONTESTANT'),
+                programmingLanguage=languages[u] if rng.random() < 0.9 else rng.choice(
+                    list(LANGUAGES)),
+                verdict=verdict, testset='TESTS',
+                passedTestCount=rng.randint(0, 50)))
+            submission_id += 1
+        status.reverse()  # newest first, like the API
+
+        changes = []
+        n = len(scored)
+        for rank, (u, *_) in enumerate(scored, 1):
+            old = ratings[u]
+            expected = n / (1 + 10 ** ((old - 1400) / 400))
+            delta = int((expected - rank) / n * 150 + rng.gauss(0, 15))
+            ratings[u] = max(0, old + delta)
+            max_ratings[u] = max(max_ratings[u], ratings[u])
+            changes.append(dict(
+                contestId=contest_id, handle=handles[u], rank=rank, oldRating=old,
+                newRating=ratings[u], ratingUpdateTimeSeconds=start_seconds + 4 * 3600))
+
+        put(f'contest.standings?contestId={contest_id}',
+            dict(contest=contest_list[-1], problems=problems, rows=rows))
+        put(f'contest.hacks?contestId={contest_id}', hacks)
+        put(f'contest.ratingChanges?contestId={contest_id}', changes)
+        put(f'contest.status?contestId={contest_id}', status)
+
+    last = int((FIRST_CONTEST_START + dt.timedelta(days=4 * contests + 1))
+               .replace(tzinfo=dt.timezone.utc).timestamp())
+    put('user.ratedList?activeOnly=false', [
+        dict(handle=handles[u], contribution=int(rng.gauss(0, 10)), rank=rank_for(ratings[u]),
+             rating=ratings[u], maxRank=rank_for(max_ratings[u]), maxRating=max_ratings[u],
+             lastOnlineTimeSeconds=last - rng.randint(0, 10 ** 7),
+             registrationTimeSeconds=last - rng.randint(10 ** 7, 10 ** 9),
+             friendOfCount=int(activity[u] * 3))
+        for u in range(users)])
+    put('contest.list', list(reversed(contest_list)))
+
+
+def _weighted_sample(rng: random.Random, population, weights, k: int):
+    """Samples k distinct items, each with probability proportional to its weight."""
+    keyed = [(rng.random() ** (1 / w), x) for x, w in zip(population, weights)]
+    keyed.sort(reverse=True)
+    return [x for _, x in keyed[:k]]
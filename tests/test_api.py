@@ -0,0 +1,39 @@
+import io
+import json
+
+import pytest
+
+from cfa import api
+
+
+def body(obj) -> io.BytesIO:
+    return io.BytesIO(json.dumps(obj).encode())
+
+
+def test_iter_result_items_split_across_chunks():
+    items = [{'id': i, 'handle': 'u' * i, 'nested': {'list': [i, [i]]}} for i in range(50)]
+    fp = body({'status': 'OK', 'result': items})
+    # Chunks smaller than an item, so that most items are cut off at least once
+    assert list(api.iter_result(fp, chunk_size=7)) == items
+
+
+def test_iter_result_empty_result():
+    assert list(api.iter_result(body({'status': 'OK', 'result': []}), chunk_size=3)) == []
+
+
+def test_iter_result_failed_body():
+    fp = body({'status': 'FAILED', 'comment': 'contestId: Contest with id 1 not found'})
+    with pytest.raises(api.ApiError) as info:
+        list(api.iter_result(fp, chunk_size=5))
+    assert info.value.response['status'] == 'FAILED'
+    assert not info.value.transient
+
+
+def test_iter_result_truncated_body():
+    data = json.dumps({'status': 'OK', 'result': [{'id': 1}, {'id': 2}, {'id': 3}]}).encode()
+    fp = io.BytesIO(data[:-12])
+    items = []
+    with pytest.raises(ValueError, match='truncated'):
+        for item in api.iter_result(fp, chunk_size=4):
+            items.append(item)
+    assert items == [{'id': 1}, {'id': 2}]
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from cfa import cosmos, models
+from cfa.achievement import Achievement, AchievementWithStats, Grant
+from cfa.sinks import FakeCosmosSink, JsonlSink, Sink
+
+
+class TrackedSink(FakeCosmosSink):
+    """A FakeCosmosSink that, like Cosmos DB, skips unchanged documents and deletes stale ones."""
+
+    skip_unchanged = True
+
+    def delete(self, doc_id: str) -> float:
+        with self.lock:
+            self.docs.pop(doc_id, None)
+        return self.base_charge
+
+
+def with_stats(title: str, handles) -> AchievementWithStats:
+    ach = Achievement(title=title, brief=title, calculate_grants=lambda: [])
+    grants = [Grant(handle, '') for handle in handles]
+    return AchievementWithStats(ach, grants, len(handles), len(handles) / 10)
+
+
+@pytest.fixture
+def db(tmp_path):
+    models.init(str(tmp_path / 'cf.db'))
+    models.connect()
+    yield
+    models.close()
+
+
+def test_achievement_ids_differ_for_titles_with_the_same_slug():
+    titles = ['C++ Master', 'C Master', 'c master', 'C-Master', 'Ünique', 'nique']
+    assert len({cosmos.achievement_id(title) for title in titles}) == len(titles)
+
+
+def test_iter_docs_rejects_duplicate_ids():
+    with pytest.raises(ValueError):
+        list(cosmos.iter_docs([with_stats('Master', ['a']), with_stats('Master', ['b'])]))
+
+
+def test_save_deletes_documents_not_made_anymore(db):
+    sink = TrackedSink(ru_per_sec=1e6)
+    cosmos.save([with_stats('Master', ['alice', 'bob'])], sink, ru_per_sec=1e6)
+    assert set(sink.docs) == {cosmos.METADATA_DOC_ID, 'alice', 'bob'}
+
+    cosmos.save([with_stats('Master', ['alice'])], sink, ru_per_sec=1e6)
+    assert set(sink.docs) == {cosmos.METADATA_DOC_ID, 'alice'}
+    assert set(models.UploadedDocument.select(models.UploadedDocument.id).tuples()) == {
+        (cosmos.METADATA_DOC_ID,), ('alice',)}
+
+
+def test_sink_without_upsert_fails_on_construction():
+    class Incomplete(Sink):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_jsonl_sink_replaces_earlier_saves(db, tmp_path):
+    path = str(tmp_path / 'docs.jsonl')
+    achievements = [with_stats('Master', ['alice', 'bob'])]
+    for _ in range(2):
+        cosmos.save(achievements, JsonlSink(path), ru_per_sec=1e6)
+    with open(path) as f:
+        ids = [json.loads(line)['id'] for line in f]
+    assert sorted(ids) == sorted([cosmos.METADATA_DOC_ID, 'alice', 'bob'])
@@ -0,0 +1,156 @@
+import contextlib
+import gzip
+import io
+import json
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from cfa import api, download, models, synth
+from cfa.cache import ResponseCache
+from cfa.models import FailedRequest, Hack, RatingChange, Submission, SyncState
+
+
+def read(cache: ResponseCache, path: str):
+    with gzip.open(cache.file_for(path)) as f:
+        return json.load(f)['result']
+
+
+def write(cache: ResponseCache, path: str, result):
+    with gzip.open(cache.file_for(path), 'wt') as f:
+        json.dump({'status': 'OK', 'result': result}, f)
+
+
+def test_contest_failures_are_queued_and_later_stages_go_on(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, 'cache', None)
+    monkeypatch.setattr(api, 'offline', False)
+    cache_dir = str(tmp_path / 'cache')
+    synth.generate(cache_dir, users=60, contests=8, seed=1)
+    cache = ResponseCache(cache_dir)
+    contest_ids = [c['id'] for c in read(cache, 'contest.list')]
+    hacks = {id_: read(cache, f'contest.hacks?contestId={id_}') for id_ in contest_ids}
+    changes = {id_: read(cache, f'contest.ratingChanges?contestId={id_}') for id_ in contest_ids}
+
+    # The standings of a contest with hacks can't be fetched, so its hacks have no problems
+    hacked = max(contest_ids, key=lambda id_: len(hacks[id_]))
+    assert hacks[hacked]
+    cache.file_for(f'contest.standings?contestId={hacked}').unlink()
+    # A user of another contest's rating changes is missing from the rated list
+    rated = next(id_ for id_ in contest_ids if id_ != hacked and changes[id_])
+    gone = changes[rated][0]['handle']
+    users = read(cache, 'user.ratedList?activeOnly=false')
+    write(cache, 'user.ratedList?activeOnly=false', [u for u in users if u['handle'] != gone])
+
+    db_path = str(tmp_path / 'cf.db')
+    with contextlib.redirect_stdout(io.StringIO()):
+        download.main(db_path, cache_dir=cache_dir, offline=True,
+                      stages=['users', 'contests', 'standings', 'hacks', 'rating-changes'])
+    try:
+        failed = set(FailedRequest.select(FailedRequest.contest, FailedRequest.endpoint).tuples())
+        assert failed == {(hacked, 'contest.standings'), (hacked, 'contest.hacks'),
+                          (rated, 'contest.ratingChanges')}
+        for endpoint in ('contest.hacks', 'contest.ratingChanges'):
+            synced = {id_ for id_, in (SyncState
+                                       .select(SyncState.contest)
+                                       .where(SyncState.endpoint == endpoint)
+                                       .tuples())}
+            assert synced == set(contest_ids) - {id_ for id_, e in failed if e == endpoint}
+        assert not Hack.select().where(Hack.contest == hacked).exists()
+        assert not RatingChange.select().where(RatingChange.contest == rated).exists()
+        assert RatingChange.select().count() == sum(
+            len(changes[id_]) for id_ in contest_ids if id_ != rated)
+    finally:
+        models.close()
+
+
+class FakeApi:
+    """Serves the calls cached in a ResponseCache, slicing contest.status by from and count."""
+
+    def __init__(self, cache: ResponseCache):
+        self.results = {path: read(cache, path)
+                        for endpoint in ('user.ratedList', 'contest.list', 'contest.standings',
+                                         'contest.status')
+                        for path in cache.calls(endpoint)}
+        results = self.results
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split('/api/', 1)[1]
+                endpoint, _, query = path.partition('?')
+                params = {key: values[0] for key, values in parse_qs(query).items()}
+                if endpoint == 'contest.status' and 'from' in params:
+                    start = int(params['from']) - 1
+                    result = results[f'contest.status?contestId={params["contestId"]}']
+                    result = result[start:start + int(params['count'])]
+                else:
+                    result = results[path]
+                body = json.dumps({'status': 'OK', 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = 'http://127.0.0.1:%d/api/' % self.server.server_address[1]
+
+    def add_submissions(self, contest_id: int, count: int):
+        """Adds `count` submissions newer than any to a contest, copying its newest one."""
+        subs = self.results[f'contest.status?contestId={contest_id}']
+        newest = max(s['id'] for path, result in self.results.items()
+                     if path.startswith('contest.status') for s in result)
+        subs[:0] = [dict(subs[0], id=newest + count - i) for i in range(count)]
+
+
+def submissions(db_path: str):
+    conn = sqlite3.connect(db_path)
+    try:
+        return sorted(conn.execute(
+            'SELECT s.id, s.contest_id, cp."index", s.author_id, s.verdict '
+            'FROM submission s JOIN contestproblem cp ON cp.id = s.problem_id'))
+    finally:
+        conn.close()
+
+
+def test_offline_rebuild_replays_incremental_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, 'cache', None)
+    monkeypatch.setattr(api, 'offline', False)
+    monkeypatch.setattr(download, 'SUBMISSION_PAGE_SIZE', 10)
+    synth_dir = str(tmp_path / 'synth')
+    synth.generate(synth_dir, users=60, contests=4, seed=2)
+    fake = FakeApi(ResponseCache(synth_dir))
+    monkeypatch.setattr(api, 'API_BASE', fake.base)
+    monkeypatch.setattr(api, 'limiter', api.RateLimiter(1000, burst=1000))
+    contest_ids = [c['id'] for c in fake.results['contest.list']]
+
+    cache_dir = str(tmp_path / 'cache')
+    db_path = str(tmp_path / 'cf.db')
+    stages = ['users', 'contests', 'standings', 'submissions']
+    run = lambda: download.main(db_path, cache_dir=cache_dir, stages=stages, incremental=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()
+        models.close()
+        # Several pages of new submissions in one contest and one page in another, over two runs
+        # whose pages share their paths
+        fake.add_submissions(contest_ids[0], 25)
+        fake.add_submissions(contest_ids[1], 3)
+        run()
+        models.close()
+        fake.add_submissions(contest_ids[0], 4)
+        run()
+        models.close()
+        fake.server.shutdown()
+
+        online = submissions(db_path)
+        assert len(online) == sum(len(fake.results[f'contest.status?contestId={id_}'])
+                                  for id_ in contest_ids)
+
+        rebuilt_path = str(tmp_path / 'rebuilt.db')
+        download.main(rebuilt_path, cache_dir=cache_dir, offline=True, stages=stages)
+        models.close()
+    assert submissions(rebuilt_path) == online
@@ -0,0 +1,100 @@
+import datetime as dt
+import sqlite3
+
+import pytest
+
+from cfa import download, migrate, models
+from cfa.models import Contest, ContestProblem, Problem, ProblemTag, Submission, User
+
+# The tables as they were before the compact layout
+OLD_TABLES = [
+    'CREATE TABLE "problem" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(128) NOT NULL, '
+    '"contest_start_time" DATETIME NOT NULL, "rating" INTEGER, "tags" VARCHAR(255) NOT NULL)',
+    'CREATE UNIQUE INDEX "problem_name_contest_start_time" '
+    'ON "problem" ("name", "contest_start_time")',
+    'CREATE TABLE "submission" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"contest_id" INTEGER NOT NULL, "problem_id" INTEGER NOT NULL, "author_id" INTEGER NOT NULL, '
+    '"type" INTEGER NOT NULL, "programming_language" VARCHAR(32) NOT NULL, '
+    '"verdict" INTEGER NOT NULL, "testset" VARCHAR(32) NOT NULL, '
+    '"passed_test_count" INTEGER NOT NULL, '
+    'FOREIGN KEY ("contest_id") REFERENCES "contest" ("id"), '
+    'FOREIGN KEY ("problem_id") REFERENCES "contestproblem" ("id"), '
+    'FOREIGN KEY ("author_id") REFERENCES "user" ("id"))',
+    'CREATE INDEX "submission_contest_id" ON "submission" ("contest_id")',
+    'CREATE INDEX "submission_problem_id" ON "submission" ("problem_id")',
+    'CREATE INDEX "submission_author_id" ON "submission" ("author_id")',
+]
+TAGS = {'A': ['dp', 'math'], 'B': [], 'C': ['math', 'strings']}
+SUBMISSIONS = [  # id, problem index, language, testset
+    (1, 'A', 'GNU C++17', 'TESTS'),
+    (2, 'A', 'Python 3', 'PRETESTS'),
+    (3, 'B', 'GNU C++17', 'TESTS'),
+    (4, 'C', 'Rust 2021', 'TESTS'),
+]
+
+
+@pytest.fixture
+def old_db(tmp_path):
+    db_path = str(tmp_path / 'cf.db')
+    models.init(db_path)
+    models.connect()
+    models.db.create_tables([User, Contest])
+    for sql in OLD_TABLES:
+        models.db.execute_sql(sql)
+    ContestProblem.create_table()
+
+    now = dt.datetime(2020, 1, 1)
+    User.create(id=1, handle='alice', contribution=0, rank='newbie', rating=1000,
+                max_rank='newbie', max_rating=1000, last_online_time=now,
+                registration_time=now, friend_of_count=0)
+    Contest.create(id=1, name='Round 1', start_time=now)
+    for problem_id, (index, tags) in enumerate(TAGS.items(), 1):
+        models.db.execute_sql(
+            'INSERT INTO problem (id, name, contest_start_time, rating, tags) VALUES (?, ?, ?, ?, ?)',
+            (problem_id, index, now, None, str(tags)))
+        ContestProblem.insert(id=problem_id, contest=1, index=index, problem=problem_id).execute()
+    for id_, index, language, testset in SUBMISSIONS:
+        models.db.execute_sql(
+            'INSERT INTO submission VALUES (?, 1, ?, 1, 0, ?, 2, ?, 10)',
+            (id_, 'ABC'.index(index) + 1, language, testset))
+    yield db_path
+    models.close()
+
+
+def test_migrate_moves_names_and_tags(old_db):
+    assert migrate.needs_migration()
+    migrate.migrate()
+    assert not migrate.needs_migration()
+
+    assert Submission.select().count() == len(SUBMISSIONS)
+    rows = (Submission
+            .select(Submission.id, ContestProblem.index, models.ProgrammingLanguage.name,
+                    models.Testset.name)
+            .join(ContestProblem).switch(Submission)
+            .join(models.ProgrammingLanguage).switch(Submission)
+            .join(models.Testset)
+            .order_by(Submission.id)
+            .tuples())
+    assert list(rows) == SUBMISSIONS
+
+    assert 'tags' not in {column.name for column in models.db.get_columns('problem')}
+    tags = {}
+    for name, tag in (ProblemTag
+                      .select(Problem.name, models.Tag.name)
+                      .join(Problem).switch(ProblemTag)
+                      .join(models.Tag)
+                      .tuples()):
+        tags.setdefault(name, []).append(tag)
+    assert {name: sorted(tags.get(name, [])) for name in TAGS} == TAGS
+
+    assert not models.db.execute_sql('PRAGMA foreign_key_check').fetchall()
+
+
+def test_download_refuses_the_old_layout(old_db):
+    models.close()
+    with pytest.raises(RuntimeError, match='cfa.migrate'):
+        download.main(old_db, stages=['users'])
+    conn = sqlite3.connect(old_db)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(submission)')]
+    conn.close()
+    assert 'programming_language' in columns
@@ -0,0 +1,61 @@
+import contextlib
+import io
+import sqlite3
+
+from cfa import api, download, models, synth
+
+# Rows by natural keys, as the shards assign their own ids
+QUERIES = {
+    'submission': '''
+        SELECT s.id, s.contest_id, cp."index", p.name, s.author_id, pl.name, t.name, s.verdict
+        FROM submission s
+        JOIN contestproblem cp ON cp.id = s.problem_id
+        JOIN problem p ON p.id = cp.problem_id
+        JOIN programminglanguage pl ON pl.id = s.programming_language_id
+        JOIN testset t ON t.id = s.testset_id''',
+    'hack': '''
+        SELECT h.id, cp."index", p.name, h.hacker_id
+        FROM hack h
+        JOIN contestproblem cp ON cp.id = h.problem_id
+        JOIN problem p ON p.id = cp.problem_id''',
+    'ranklistrow': 'SELECT contest_id, user_id, rank, points FROM ranklistrow',
+    'problemresult': 'SELECT contest_id, user_id, problem_index, points FROM problemresult',
+    'ratingchange': 'SELECT contest_id, user_id, new_rating FROM ratingchange',
+    'problemtag': '''
+        SELECT p.name, t.name
+        FROM problemtag pt
+        JOIN problem p ON p.id = pt.problem_id
+        JOIN tag t ON t.id = pt.tag_id''',
+    'syncstate': 'SELECT contest_id, endpoint, contest_finished, max_submission_id FROM syncstate',
+    'userstats': 'SELECT * FROM userstats',
+}
+
+
+def dump(db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        return {table: sorted(conn.execute(query)) for table, query in QUERIES.items()}
+    finally:
+        conn.close()
+
+
+def load(db_path: str, cache_dir: str, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        download.main(db_path, cache_dir=cache_dir, offline=True, **kwargs)
+    models.db.close()
+
+
+def test_sharded_download_matches_single_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, 'cache', None)
+    monkeypatch.setattr(api, 'offline', False)
+    cache_dir = str(tmp_path / 'cache')
+    synth.generate(cache_dir, users=60, contests=8, seed=1)
+
+    # In bulk mode, so that both rebuild the aggregates instead of updating them per contest
+    load(str(tmp_path / 'single.db'), cache_dir, bulk=True)
+    load(str(tmp_path / 'sharded.db'), cache_dir, shards=3)
+
+    single = dump(str(tmp_path / 'single.db'))
+    assert single['submission'] and single['ranklistrow']
+    assert dump(str(tmp_path / 'sharded.db')) == single
+    assert not list(tmp_path.glob('sharded.db.shard*'))